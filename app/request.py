@@ -1,12 +1,49 @@
 """Request类，从 WSGI 服务器拿到请求并解析"""
 
-from urllib.parse import unquote, quote
+from functools import lru_cache
+from urllib.parse import unquote_plus, quote
 from io import BytesIO
 
-from server.utils import Headers, cache_property, log
+# 通过模块访问 json_loads，set_json_backend() 替换后立即生效
+from app import response as _response
+from server.utils import (
+    Headers, MultiDict, ImmutableMultiDict, CombinedMultiDict,
+    cache_property, cached_slots, log,
+)
+
+
+def _unquote(s):
+    # 大部分参数不含转义字符，直接返回，省去解码
+    if '%' in s or '+' in s:
+        return unquote_plus(s)
+    return s
+
+
+def parse_qs(qs):
+    """解析 `a=1&b=2&a=3` 格式的字符串，返回 (key, value) 列表
+    同名的键全部保留，没有 `=` 的键值为空字符串"""
+    pairs = []
+    for pair in qs.split('&'):
+        if not pair:
+            continue
+        k, _, v = pair.partition('=')
+        pairs.append((_unquote(k), _unquote(v)))
+    return pairs
+
+
+@lru_cache(maxsize=128)
+def _parse_query(query_string):
+    """热点 URL 的查询字符串往往完全相同，缓存解析结果。
+    返回只读的 MultiDict，可以在请求之间共享"""
+    return ImmutableMultiDict(parse_qs(query_string))
 
 
 class Request:
+    __slots__ = ('environ',) + cached_slots(
+        'headers', 'cookies', 'form', 'params', 'method', 'host', 'path',
+        'full_path', 'base_url', 'url', 'script_name', 'query',
+        'content_type', 'content_encoding', '_body', 'json',
+    )
     MEMFILE_MAX = 102400  # 内存最大缓存100k
     headers_cls = Headers
 
@@ -39,9 +76,28 @@ class Request:
 
     @cache_property
     def params(self):
-        params = self.query.copy()
-        params.update(self.form)
-        return params
+        """查询参数和表单的合并视图，同名时表单优先"""
+        return CombinedMultiDict((self.query, self.form))
+
+    @cache_property
+    def json(self):
+        """请求体按 JSON 解码，Content-Type 不是 JSON 时返回 None"""
+        mime_type = self.content_type.get('mime_type', '')
+        if not (mime_type == 'application/json'
+                or mime_type.endswith('+json')):
+            return None
+
+        # 读取请求体之前先检查大小
+        if self.content_length > self.MEMFILE_MAX:
+            raise ValueError('Request body too large')
+        return _response.json_loads(self._body.getvalue())
+
+    @property
+    def content_length(self):
+        try:
+            return int(self.environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            return 0
 
     @cache_property
     def method(self):
@@ -90,23 +146,7 @@ class Request:
 
     @cache_property
     def query(self):
-        q = {}
-        query_string = self.query_string
-        if query_string == '' or query_string is None:
-            return q
-
-        for pair in query_string.split('&'):
-            if not pair:
-                continue
-
-            kv_list = pair[:].split('=', 1)
-
-            if len(kv_list) == 2:
-                key = unquote(kv_list[0].replace('+', ' '))
-                value = unquote(kv_list[1].replace('+', ' '))
-                q[key] = value
-
-        return q
+        return _parse_query(self.query_string)
 
     @property
     def remote_addr(self):
@@ -151,28 +191,23 @@ class Request:
 
         return cookies
 
+    @property
+    def stream(self):
+        """服务器提供的 wsgi.input 已按 Content-Length 限制长度，
+        可以直接流式读取请求体，不经过内存复制"""
+        return self.environ.get('wsgi.input', BytesIO())
+
     @cache_property
     def _body(self):
-        input_stream = self.environ.get('wsgi.input', BytesIO())
         buffer = BytesIO()
-        try:
-            content_length = int(self.environ.get('CONTENT_LENGTH'))
-        except ValueError:
-            content_length = 0
-
-        read_size = min(4096, content_length)
+        content_length = self.content_length
 
         if 'chunked' in self.environ.get('HTTP_TRANSFER_ENCODING', '').lower():
             log('Not supported chunked file upload')
             return
             # TODO: 处理 chunk 数据
 
-        buffer.write(input_stream.read(read_size))
-        pos = buffer.tell()
-        while pos < content_length and pos < self.MEMFILE_MAX:
-            buffer.write(input_stream.read(read_size))
-            pos = buffer.tell()
-
+        buffer.write(self.stream.read(min(content_length, self.MEMFILE_MAX)))
         buffer.flush()
 
         return buffer
@@ -194,17 +229,12 @@ class Request:
         return content_type
 
     def _parse_form(self):
-        forms = {}
         mime_type = self.content_type.get('mime_type')
-        forms_str = self.body.read().decode(self.content_encoding)
 
         if (self.method == 'POST'
                 and mime_type == 'application/x-www-form-urlencoded'
         ):
-            param_lst = forms_str.split('&')
-            for param in param_lst:
-                k, v = param.split('=')
-                k, v = k.strip(), v.strip()
-                forms[k] = v
+            forms_str = self.body.read().decode(self.content_encoding)
+            return MultiDict(parse_qs(forms_str))
 
-        return forms
+        return MultiDict()
@@ -1,3 +1,9 @@
+"""响应状态码以及 JSON 响应"""
+
+import json
+
+__all__ = ['HTTP_STATUS_CODES', 'JSONResponse', 'json_dumps', 'json_loads',
+           'set_json_backend']
 
 HTTP_STATUS_CODES = {
     100: "Continue",
@@ -65,3 +71,85 @@ HTTP_STATUS_CODES = {
     510: "Not Extended",
     511: "Network Authentication Failed",  # see RFC 6585
 }
+
+
+def _dumps(obj):
+    return json.dumps(obj, ensure_ascii=False,
+                      separators=(',', ':')).encode('utf-8')
+
+
+# 安装了 orjson 时默认使用，否则使用标准库
+try:
+    import orjson
+except ImportError:
+    json_dumps, json_loads = _dumps, json.loads
+else:
+    json_dumps, json_loads = orjson.dumps, orjson.loads
+
+
+def set_json_backend(dumps=None, loads=None):
+    """运行时替换 JSON 编解码函数
+
+    :param dumps: obj -> bytes
+    :param loads: bytes -> obj
+    """
+    global json_dumps, json_loads
+    if dumps is not None:
+        json_dumps = dumps
+    if loads is not None:
+        json_loads = loads
+
+
+class JSONResponse:
+    """JSON 响应，本身是一个 WSGI application::
+
+        return JSONResponse({'ok': True})(environ, start_response)
+
+    dict, list 等一次编码，设置 Content-Length。
+    生成器等长度未知的可迭代对象 (或 stream=True) 按 JSON 数组逐个元素编码，
+    攒够 chunk_size 字节发送一块，由服务器使用 chunked 传输，
+    不需要把整个文档保存在内存中。
+    """
+    chunk_size = 16 * 1024
+    content_type = 'application/json'
+
+    def __init__(self, data, status=200, headers=None, stream=None):
+        self.data = data
+        self.status = status
+        self.headers = headers or []
+        if stream is None:
+            stream = not isinstance(
+                data, (dict, list, tuple, str, int, float, bool, type(None)))
+        self.stream = stream
+
+    def __call__(self, environ, start_response):
+        status = f'{self.status} {HTTP_STATUS_CODES.get(self.status, "")}'
+        status = status.rstrip()
+        headers = [('Content-Type', self.content_type)]
+        headers.extend(self.headers)
+
+        if self.stream:
+            start_response(status, headers)
+            return self.iter_encoded()
+
+        body = json_dumps(self.data)
+        headers.append(('Content-Length', str(len(body))))
+        start_response(status, headers)
+        return [body]
+
+    def iter_encoded(self):
+        dumps = json_dumps
+        chunk_size = self.chunk_size
+        buffer = bytearray(b'[')
+        first = True
+        for item in self.data:
+            if first:
+                first = False
+            else:
+                buffer += b','
+            buffer += dumps(item)
+            if len(buffer) >= chunk_size:
+                yield bytes(buffer)
+                buffer.clear()
+        buffer += b']'
+        yield bytes(buffer)
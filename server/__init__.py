@@ -1,7 +1,12 @@
 
-__all__ = ['make_server', 'utils', 'RequestsHandler']
+__all__ = ['make_server', 'utils', 'RequestsHandler', 'RateLimiter',
+           'Bulkhead', 'Bulkheads', 'ETagMiddleware', 'H2CHandler']
 
 
 from .server import make_server
 from . import utils
 from .handler import RequestsHandler
+from .ratelimit import RateLimiter
+from .bulkhead import Bulkhead, Bulkheads
+from .etag import ETagMiddleware
+from .http2 import H2CHandler
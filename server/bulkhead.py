@@ -0,0 +1,163 @@
+"""舱壁隔离中间件，按路由限制并发数，并传递请求截止时间"""
+
+import math
+import threading
+from time import monotonic
+
+from server.utils import ClosingIterator
+
+__all__ = ['Bulkhead', 'Bulkheads']
+
+
+class Bulkhead:
+    """一个有名字的并发限制
+
+    最多 limit 个请求同时执行，另外最多 queue_size 个请求排队等待，
+    队列满了或者等待超时的请求直接拒绝，不会占用更多的工作线程。
+    """
+
+    def __init__(self, name, limit, queue_size=0, max_wait=1.0):
+        """
+        :param max_wait: 排队等待的最长秒数，请求截止时间更早时以截止时间为准
+        """
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.active = 0  # 正在执行的请求数
+        self.waiting = 0  # 排队等待的请求数
+        self._cond = threading.Condition(threading.Lock())
+
+    def __repr__(self):
+        return (f'<{type(self).__name__} {self.name} '
+                f'{self.active}/{self.limit} waiting={self.waiting}>')
+
+    def acquire(self, deadline=None):
+        """获取一个执行名额，成功返回 True
+
+        :param deadline: monotonic() 时间点，超过后不再等待
+        """
+        with self._cond:
+            if self.active < self.limit:
+                self.active += 1
+                return True
+            if self.waiting >= self.queue_size:
+                return False
+
+            end = monotonic() + self.max_wait
+            if deadline is not None:
+                end = min(end, deadline)
+            self.waiting += 1
+            try:
+                while self.active >= self.limit:
+                    remaining = end - monotonic()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.active += 1
+            return True
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+
+def _response(status, body, retry_after=None):
+    headers = [('Content-Type', 'text/plain'),
+               ('Content-Length', str(len(body)))]
+    if retry_after is not None:
+        headers.append(('Retry-After', str(retry_after)))
+    return status, headers, body
+
+
+class Bulkheads:
+    """WSGI 中间件，按路径前缀把请求分配到不同的 Bulkhead::
+
+        app = Bulkheads(app, {
+            '/report': Bulkhead('report', limit=4, queue_size=8),
+            '/api/search': Bulkhead('search', limit=16),
+        }, default_timeout=5)
+
+    路径匹配最长的前缀，没有匹配的请求不受限制 (或使用 default)。
+    一个慢路由最多占用自己的名额，其他路由的请求不会被饿死。
+
+    请求截止时间来自 deadline_header 请求头 (相对秒数) 或 default_timeout,
+    请求头只能缩短 default_timeout，不能延长，非有限值 (nan、inf) 被忽略。
+    从服务器记录的请求开始时间 environ['server.started'] 算起，
+    以 monotonic() 时间点保存在 environ['server.deadline']，app 可以据此
+    设置下游调用的超时。截止时间在 app 开始执行前已经过去的请求直接返回 504。
+    """
+    deadline_key = 'server.deadline'
+    rejected = _response('503 Service Unavailable', b'Service Unavailable', 1)
+    expired = _response('504 Gateway Timeout', b'Gateway Timeout')
+
+    def __init__(self, app, routes=None, default=None,
+                 deadline_header='X-Request-Timeout', default_timeout=None):
+        self.app = app
+        # 最长的前缀优先匹配
+        self.routes = sorted((routes or {}).items(),
+                             key=lambda item: len(item[0]), reverse=True)
+        self.default = default
+        self.deadline_header = ('HTTP_' + deadline_header.upper()
+                                .replace('-', '_'))
+        self.default_timeout = default_timeout
+
+    def __call__(self, environ, start_response):
+        deadline = self.request_deadline(environ)
+        environ[self.deadline_key] = deadline
+
+        bulkhead = self.match(environ.get('PATH_INFO') or '/')
+        if bulkhead is not None and not bulkhead.acquire(deadline):
+            if deadline is not None and monotonic() >= deadline:
+                return self.respond(self.expired, start_response)
+            return self.respond(self.rejected, start_response)
+
+        if deadline is not None and monotonic() >= deadline:
+            if bulkhead is not None:
+                bulkhead.release()
+            return self.respond(self.expired, start_response)
+
+        if bulkhead is None:
+            return self.app(environ, start_response)
+        try:
+            app_iter = self.app(environ, start_response)
+        except BaseException:
+            bulkhead.release()
+            raise
+        # 响应发送完 (服务器调用 close) 才释放名额
+        return ClosingIterator(app_iter, bulkhead.release)
+
+    def match(self, path):
+        for prefix, bulkhead in self.routes:
+            if path.startswith(prefix):
+                return bulkhead
+        return self.default
+
+    def request_deadline(self, environ):
+        timeout = self.default_timeout
+        value = environ.get(self.deadline_header)
+        if value:
+            try:
+                requested = float(value)
+            except ValueError:
+                requested = None
+            if requested is not None and math.isfinite(requested):
+                # 客户端不能绕过运维设置的截止时间
+                if timeout is None or requested < timeout:
+                    timeout = requested
+        if timeout is None:
+            return None
+        # 排队等待 accept、读取请求头的时间也要算在内
+        started = environ.get('server.started')
+        if started is None:
+            started = monotonic()
+        return started + timeout
+
+    @staticmethod
+    def respond(response, start_response):
+        status, headers, body = response
+        start_response(status, list(headers))
+        return [body]
@@ -17,6 +17,8 @@ CGI_ENVIRON = {
     'SERVER_PROTOCOL': '',
     'SERVER_NAME': '',
     'SERVER_PORT': '',
+    'REMOTE_ADDR': '',
+    'REMOTE_PORT': '',
 }
 
 
@@ -31,12 +33,14 @@ WSGI_ENVIRON = {
 }
 
 
-def setup_environ(request, server):
+# 启动时合并好的基础 environ, 每个请求只需要复制一次
+BASE_ENVIRON = {**OS_ENVIRON, **CGI_ENVIRON, **WSGI_ENVIRON}
+
+
+def setup_environ(request, server, client_address=None):
+    """:param client_address: accept() 返回的客户端地址，Unix 域套接字为空"""
     header = request.header
-    env = {}
-    env.update(OS_ENVIRON)
-    env.update(CGI_ENVIRON)
-    env.update(WSGI_ENVIRON)
+    env = BASE_ENVIRON.copy()
 
     env['wsgi.input'] = ''
     env['wsgi.url_scheme'] = 'http'
@@ -44,8 +48,11 @@ def setup_environ(request, server):
     env['PATH_INFO'] = request.path
     env['QUERY_STRING'] = request.query_string or ''
     env['SERVER_PROTOCOL'] = request.version
-    env['SERVER_NAME'] = server.server_address[0]
-    env['SERVER_PORT'] = server.server_address[1]
+    env['SERVER_NAME'] = server.server_name
+    env['SERVER_PORT'] = server.server_port
+    if isinstance(client_address, tuple):
+        env['REMOTE_ADDR'] = client_address[0]
+        env['REMOTE_PORT'] = str(client_address[1])
 
     for k, v in header:
         k = k.upper().replace("-", "_")
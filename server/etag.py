@@ -0,0 +1,211 @@
+"""ETag 中间件，为动态响应计算 ETag 并处理 If-None-Match 条件请求"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import partial
+
+from server.utils import ClosingIterator
+
+__all__ = ['ETagMiddleware']
+
+
+# 304 响应需要保留的响应头 (RFC 7232 4.1)
+_KEEP_304_HEADERS = frozenset((
+    'cache-control', 'content-location', 'date', 'etag', 'expires', 'vary',
+))
+
+
+def _close(iterable):
+    if hasattr(iterable, 'close'):
+        iterable.close()
+
+
+class ETagMiddleware:
+    """WSGI 中间件，给 GET/HEAD 的 200 响应加上强 ETag::
+
+        app = ETagMiddleware(app, version_key=lambda environ: ...)
+
+    - app 自己设置了 ETag 时直接和 If-None-Match 比较，匹配则不发送响应体。
+    - 否则在 app 逐块返回响应体时增量计算哈希，响应体不超过 buffer_size 时
+      全部缓存下来，得到 ETag 后再决定返回 304 还是完整响应。
+    - 更大的响应体边计算边发送，无法提前给出 ETag。
+    - HEAD 的响应体通常为空，不计算哈希，只使用同一版本的 GET 缓存的 ETag。
+
+    version_key(environ) 返回资源的版本标识 (如数据库记录的更新时间)，
+    中间件按版本缓存算出的 ETag，客户端带着匹配的 If-None-Match 再次请求时
+    直接返回 304，完全不调用 app。
+    """
+    hash_factory = staticmethod(lambda: hashlib.blake2b(digest_size=16))
+
+    def __init__(self, app, buffer_size=64 * 1024, version_key=None,
+                 cache_size=1024):
+        self.app = app
+        self.buffer_size = buffer_size
+        self.version_key = version_key
+        self.cache_size = cache_size
+        self._cache = OrderedDict()  # 版本标识 -> ETag
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        if environ.get('REQUEST_METHOD') not in ('GET', 'HEAD'):
+            return self.app(environ, start_response)
+
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        key = self.version_key(environ) if self.version_key else None
+        if key is not None and if_none_match:
+            etag = self._cached(key)
+            if etag is not None and self._matches(etag, if_none_match):
+                return self._not_modified(start_response, [('ETag', etag)])
+
+        captured = []
+        blocks = []
+
+        def capture(status, headers, exc_info=None):
+            if captured and exc_info is None:
+                raise AssertionError('Headers already set!')
+            if not status.startswith('200'):
+                # 只处理 200 响应，其他直接交给服务器
+                captured[:] = [status, headers, False]
+                return start_response(status, headers, exc_info)
+            captured[:] = [status, headers, True]
+            return blocks.append
+
+        app_iter = self.app(environ, capture)
+        iterator = iter(app_iter)
+        close = partial(_close, app_iter)
+        try:
+            if not captured:
+                # 生成器形式的 app 第一次迭代时才调用 start_response
+                for block in iterator:
+                    blocks.append(block)
+                    break
+        except BaseException:
+            close()
+            raise
+
+        if not captured or not captured[2]:
+            return _remaining(app_iter, blocks, iterator, close)
+        status, headers = captured[0], captured[1]
+
+        etag = _header(headers, 'etag')
+        if etag is not None:
+            # app 提供了 ETag，不需要计算，同样按版本缓存
+            if key is not None:
+                self._store(key, etag)
+            if if_none_match and self._matches(etag, if_none_match):
+                close()
+                return self._not_modified(start_response, headers)
+            start_response(status, headers)
+            return _remaining(app_iter, blocks, iterator, close)
+
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            # 空响应体的哈希和 GET 的不同，也不能据此设置 Content-Length。
+            # 缓存的 ETag 和 If-None-Match 匹配时前面已经返回了 304
+            etag = self._cached(key) if key is not None else None
+            if etag is not None:
+                headers.append(('ETag', etag))
+            start_response(status, headers)
+            return _remaining(app_iter, blocks, iterator, close)
+
+        digest = self.hash_factory()
+        size = 0
+        for block in blocks:
+            digest.update(block)
+            size += len(block)
+        complete = False
+        try:
+            if size <= self.buffer_size:
+                for block in iterator:
+                    blocks.append(block)
+                    digest.update(block)
+                    size += len(block)
+                    if size > self.buffer_size:
+                        break
+                else:
+                    complete = True
+        except BaseException:
+            close()
+            raise
+
+        if complete:
+            # 响应体已全部读取，ETag 确定
+            close()
+            etag = f'"{digest.hexdigest()}"'
+            if key is not None:
+                self._store(key, etag)
+            headers.append(('ETag', etag))
+            if if_none_match and self._matches(etag, if_none_match):
+                return self._not_modified(start_response, headers)
+            if _header(headers, 'content-length') is None:
+                headers.append(('Content-Length', str(size)))
+            start_response(status, headers)
+            return blocks
+
+        # 响应体太大，先发送已缓存的部分，剩余部分边发送边计算
+        start_response(status, headers)
+        return ClosingIterator(self._stream(blocks, iterator, digest, key),
+                               close)
+
+    def _stream(self, blocks, iterator, digest, key):
+        yield from blocks
+        for block in iterator:
+            digest.update(block)
+            yield block
+        if key is not None:
+            # 下次同一版本的条件请求可以直接返回 304
+            self._store(key, f'"{digest.hexdigest()}"')
+
+    @staticmethod
+    def _matches(etag, if_none_match):
+        """If-None-Match 使用弱比较，忽略 W/ 前缀"""
+        if if_none_match.strip() == '*':
+            return True
+        etag = etag[2:] if etag.startswith('W/') else etag
+        for tag in if_none_match.split(','):
+            tag = tag.strip()
+            if tag.startswith('W/'):
+                tag = tag[2:]
+            if tag == etag:
+                return True
+        return False
+
+    @staticmethod
+    def _not_modified(start_response, headers):
+        headers = [(k, v) for k, v in headers
+                   if k.lower() in _KEEP_304_HEADERS]
+        start_response('304 Not Modified', headers)
+        return []
+
+    def _cached(self, key):
+        with self._lock:
+            etag = self._cache.get(key)
+            if etag is not None:
+                self._cache.move_to_end(key)
+            return etag
+
+    def _store(self, key, etag):
+        with self._lock:
+            self._cache[key] = etag
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+
+def _remaining(app_iter, blocks, iterator, close):
+    """原样返回 app 的响应体，已经取出的块放在前面"""
+    if not blocks:
+        return app_iter
+    return ClosingIterator(_chain(blocks, iterator), close)
+
+
+def _chain(blocks, iterator):
+    yield from blocks
+    yield from iterator
+
+
+def _header(headers, name):
+    for k, v in headers:
+        if k.lower() == name:
+            return v
+    return None
@@ -1,68 +1,354 @@
 """ 请求处理 """
 
 import time
-from io import BufferedIOBase
+import socket
+from functools import partial
+from time import perf_counter, monotonic
 
 from server.environ import setup_environ
 from server.request import Request
+from server.pool import buffer_pool
+from server.stream import InputStream
+from server.tracing import (Trace, NULL_TRACE, should_sample,
+                            parse_traceparent)
 from server.utils import logged, log, Headers, format_date_time
 
 
-class _SocketWriter(BufferedIOBase):
-    """接受一个套接字对象"""
+class _SocketWriter:
+    """接受一个套接字对象
 
-    def __init__(self, sock):
+    小块数据先写入池里借来的定长缓冲区，flush() 时一次 sendall 发出，
+    响应行、响应头和第一块 body 合并成一次系统调用。
+    """
+    __slots__ = ('_sock', '_buffer', '_pos')
+
+    def __init__(self, sock=None):
+        self._sock = sock
+        self._buffer = None
+        self._pos = 0
+
+    def attach(self, sock):
         self._sock = sock
+        self._buffer = buffer_pool.acquire()
+        self._pos = 0
+
+    def detach(self):
+        if self._buffer is not None:
+            buffer_pool.release(self._buffer)
+        self._sock = self._buffer = None
+        self._pos = 0
 
     def writable(self):
         return True
 
     def write(self, b):
-        self._sock.sendall(b)
         with memoryview(b) as view:
-            return view.nbytes
+            nbytes = view.nbytes
+            pos = self._pos
+            end = pos + nbytes
+            if end <= len(self._buffer):
+                self._buffer[pos:end] = view
+                self._pos = end
+            else:
+                # 放不下则先发出缓冲区，大块数据直接发送不复制
+                self.flush()
+                self._sock.sendall(view)
+        return nbytes
 
     def fileno(self):
         return self._sock.fileno()
 
     def flush(self):
-        """"直接写入内存试图，不用调用刷新 flush"""
-        pass
+        if self._pos:
+            with memoryview(self._buffer) as view:
+                self._sock.sendall(view[:self._pos])
+            self._pos = 0
+
+
+class _Overloaded(Exception):
+    """keep-alive 连接收到新请求时服务器已过载"""
+
+
+def _no_body_status(status):
+    """1xx、204、304 响应没有响应体，也不需要 Content-Length 确定长度"""
+    return status[0] == '1' or status[:3] in ('204', '304')
+
+
+def rejection(status, headers=None):
+    """pre_body() 返回的响应，响应体是状态描述"""
+    body = status.encode('latin-1')
+    headers = list(headers or ())
+    headers += [('Content-Type', 'text/plain'),
+                ('Content-Length', str(len(body)))]
+    return status, headers, body
 
 
 class RequestsHandler:
-    timeout = 3  # 套接字超时
+    """处理一个连接
+
+    __slots__ 减小实例体积，处理完成后实例可以放回服务器的对象池
+    在下一个连接上复用，见 :meth:`process`。
+    """
+    __slots__ = (
+        'conn', 'client_address', 'server', 'app', 'rfile', '_wfile',
+        'input',  # wsgi.input
+        'request', 'env',
+        'close_connection',  # 响应结束后是否关闭连接
+        'chunked',  # 响应体是否使用 chunked 传输编码
+        'headers',  # http headers
+        'headers_sent',  # 是否发送 header 标志
+        'status',  # app 响应状态码， app 是否响应标志
+        'bytes_sent',  # 已发送字节大小
+        'app_result',  # app 返回的 body
+        'phase',  # 当前所处的超时阶段
+        'expired',  # 超时的阶段
+        '_timer',
+        'trace',  # 请求追踪, environ['server.trace']
+        '_accepted',  # 连接建立的时间点，只用于连接上的第一个请求
+        '_started',  # 收到请求行的时间点
+        '_idle',  # keep-alive 连接正在等待下一个请求
+    )
+
+    # 各阶段时长上限，由服务器共用的时间轮检查，防止慢速客户端长期占用线程。
+    # app 自己的处理时间不受限制，截止时间只在等待客户端时生效
+    idle_timeout = 5  # 等待请求行
+    header_timeout = 10  # 读取请求头
+    body_timeout = 30  # 每次读取 wsgi.input
+    write_timeout = 30  # 每次发送响应数据
+    # 套接字超时，单次阻塞调用的兜底上限，只在时间轮失效时起作用。
+    # None 时取上面最长的阶段再加 1 秒，不能比阶段上限先触发
+    timeout = None
+    max_drain = 64 * 1024  # app 未读取的请求体不超过该大小时丢弃后复用连接
+    trace_sample_rate = 0.0  # 请求追踪的采样率
+    trace_follow_parent = True  # traceparent 标记已采样的请求总是追踪
+    server_timing = False  # 追踪的请求添加 Server-Timing 响应头
     headers_class = Headers
-    headers = None  # http headers
-    headers_sent = None  # 是否发送 header 标志
-    status = None  # app 响应状态码， app 是否响应标志
-    bytes_sent = None  # 已发送字节大小
-    app_result = None  # app 返回的 body
-
-    def __init__(self, connection, client_address, server):
+    # 读取请求体之前的检查，见 pre_body()
+    max_body_size = None  # Content-Length 超过时返回 413
+    body_types = None  # 允许的请求体 Content-Type，如 ('application/json',)
+
+    def __init__(self, connection=None, client_address=None, server=None):
+        self._wfile = _SocketWriter()
+        self.input = InputStream()
+        self.conn = self.client_address = self.server = self.app = None
+        self.rfile = self._timer = None
+        self._idle = False
+        self.reset()
+
+        if connection is not None:
+            self.process(connection, client_address, server)
+
+    def reset(self):
+        """清理上一个请求的状态"""
+        self.request = self.env = None
+        self.app_result = self.headers = self.status = None
+        self.bytes_sent = 0
+        self.headers_sent = False
+        self.phase = self.expired = None
+        self.close_connection = True
+        self.chunked = False
+        self.trace = NULL_TRACE
+        self._accepted = self._started = None
+
+    def process(self, connection, client_address, server):
+        """处理一个连接，处理完后实例可以复用"""
         self.conn = connection
-        self.conn.settimeout(self.timeout)
+        self.conn.settimeout(self.socket_timeout())
         self.client_address = client_address
         self.server = server
         self.app = self.server.app
-        self._wfile = _SocketWriter(self.conn)
-        self.request = None
-        self.env = None
+        self.rfile = self.conn.makefile('rb')
+        self._wfile.attach(self.conn)
+        self._accepted = perf_counter()
 
         try:
-            self.setup()
-            self.handle()
+            # HTTP/1.1 keep-alive, 一个连接上依次处理多个请求
+            while True:
+                self.set_deadline('idle')
+                self.setup()
+                if self.request is None:
+                    break
+                self.handle()
+                if self.close_connection or not self.finish_request():
+                    break
+                self.reset()
+                self._accepted = None
+                self._set_idle(True)
+        except _Overloaded:
+            # 和 accept 时一样返回 503 后延迟关闭，dup 出的套接字
+            # 不会随 finish() 关闭，由服务器的时间轮负责
+            self.server.reject_request(self.conn.dup())
+        except OSError:
+            # 等待下一个请求时客户端断开或超时，属于正常关闭
+            if self.expired is None and self.phase != 'idle':
+                raise
+        except Exception:
+            if self.expired is None:
+                raise
         finally:
+            self._set_idle(False)
+            if self.expired is not None:
+                log(f'Connection timed out in {self.expired} phase')
             self.finish()
 
+    def socket_timeout(self):
+        if self.timeout is not None:
+            return self.timeout
+        return max(self.idle_timeout, self.header_timeout, self.body_timeout,
+                   self.write_timeout) + 1
+
+    def _set_idle(self, idle, admit=False):
+        """空闲的 keep-alive 连接不算服务器正在处理的请求
+
+        :return: admit=True 且服务器已过载时返回 False，连接仍是空闲状态
+        """
+        if self._idle != idle:
+            if not self.server.connection_idle(idle, admit):
+                return False
+            self._idle = idle
+        return True
+
+    def set_deadline(self, phase):
+        """进入新的阶段，替换时间轮上的定时器"""
+        wheel = self.server.timer_wheel
+        if self._timer is not None:
+            wheel.cancel(self._timer)
+        self.phase = phase
+        delay = getattr(self, f'{phase}_timeout')
+        self._timer = wheel.schedule(delay, partial(self._expire, self.conn))
+
+    def clear_deadline(self):
+        if self._timer is not None:
+            self.server.timer_wheel.cancel(self._timer)
+            self._timer = None
+
+    def _expire(self, conn):
+        """时间轮线程里调用，只关闭套接字，阻塞中的读写会立即返回
+
+        定时器绑定的是当时的连接，实例已被复用时不会误关新连接
+        """
+        if conn is self.conn:
+            self.expired = self.phase
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
     def setup(self):
-        self.request = Request.execute(self.conn)
-        self.env = setup_environ(self.request, self.server)
-        self.env['wsgi.input'] = self.conn.makefile('rb')
+        # 解析请求和 wsgi.input 共用一个带缓冲的读文件，
+        # 否则解析请求头时预读到缓冲里的 body 会丢失
+        self.request = Request.execute(self.rfile, self._request_line_read)
+        if self.request is None:
+            return
+        parsed = perf_counter()
+        # app 执行期间没有截止时间，读取请求体时由 wsgi.input 设置
+        self.clear_deadline()
+        self.close_connection = not self.request.keep_alive
+        if self.request.header.get('Transfer-Encoding'):
+            # 不支持分块上传的请求体，无法确定请求结束的位置
+            self.close_connection = True
+        expect = self.request.header.get('Expect')
+        if (expect is not None and expect.lower() == '100-continue'
+                and self.request.version == 'HTTP/1.1'):
+            # 客户端发送请求体之前等待 100 Continue，app 第一次读取时才发送，
+            # app 不读取请求体 (或被 pre_body 拒绝) 时客户端就不用发送了
+            self.input.reset(self.rfile, self.request.content_length,
+                             self.send_continue, self._body_deadline)
+        else:
+            self.input.reset(self.rfile, self.request.content_length,
+                             deadline=self._body_deadline)
+        self.env = setup_environ(self.request, self.server,
+                                 self.client_address)
+        self.env['wsgi.input'] = self.input
+        # 请求开始的 monotonic() 时间点，连接上的第一个请求从 accept 算起,
+        # 包括读取请求头的时间，供中间件计算请求截止时间
+        started = self._accepted if self._accepted is not None \
+            else self._started
+        self.env['server.started'] = monotonic() - (parsed - started)
+        self.start_trace(parsed)
+
+    def _body_deadline(self, active):
+        """wsgi.input 读取套接字前后调用"""
+        if active:
+            self.set_deadline('body')
+        else:
+            self.clear_deadline()
+
+    def _request_line_read(self, phase):
+        if not self._set_idle(False, admit=True):
+            raise _Overloaded
+        self._started = perf_counter()
+        self.set_deadline(phase)
+
+    def start_trace(self, parsed):
+        """按采样率开始追踪，未采样时只多了两次取时间的开销"""
+        traceparent = parse_traceparent(self.env.get('HTTP_TRACEPARENT'))
+        if not should_sample(traceparent, self.trace_sample_rate,
+                             self.trace_follow_parent):
+            self.trace = NULL_TRACE
+        else:
+            marks = [('request', self._started), ('parse', parsed)]
+            if self._accepted is not None:
+                # 连接上的第一个请求，request 阶段是连接建立到收到请求行
+                marks.insert(0, ('accept', self._accepted))
+            self.trace = Trace(marks, traceparent)
+            self.trace.mark('environ')
+        self.env['server.trace'] = self.trace
+
+    def finish_request(self):
+        """丢弃未读取的请求体，返回连接能否继续使用"""
+        return self.input.drain(self.max_drain)
 
     def handle(self):
         log(self.request)
-        self.run_wsgi()
+        response = self.pre_body(self.env)
+        if response is not None:
+            self.respond(response)
+        else:
+            self.run_wsgi()
+
+    def pre_body(self, environ):
+        """请求头解析完、读取请求体之前调用
+
+        返回 rejection() 的 (status, headers, body) 时直接响应，不调用 app,
+        请求体不会被读取。子类可以覆盖，加上认证 (401) 等检查::
+
+            class UploadHandler(RequestsHandler):
+                max_body_size = 10 * 1024 * 1024
+
+                def pre_body(self, environ):
+                    if 'HTTP_AUTHORIZATION' not in environ:
+                        return rejection('401 Unauthorized',
+                                         [('WWW-Authenticate', 'Bearer')])
+                    return super().pre_body(environ)
+        """
+        expect = environ.get('HTTP_EXPECT')
+        if expect is not None and expect.lower() != '100-continue':
+            return rejection('417 Expectation Failed')
+        length = self.request.content_length
+        if self.max_body_size is not None and length > self.max_body_size:
+            return rejection('413 Payload Too Large')
+        if self.body_types is not None and length:
+            content_type = environ.get('CONTENT_TYPE', '')
+            if content_type.split(';', 1)[0].strip().lower() \
+                    not in self.body_types:
+                return rejection('415 Unsupported Media Type')
+        return None
+
+    def respond(self, response):
+        """不经过 app 直接发送一个完整的响应"""
+        status, headers, body = response
+        self.start_response(status, list(headers))
+        self.app_result = [body]
+        self.finish_response()
+
+    def send_continue(self):
+        """wsgi.input 第一次读取时调用，通知客户端发送请求体"""
+        if self.headers_sent:
+            # 已经开始发送最终响应，不能再发送 1xx
+            return
+        self._write(b'HTTP/1.1 100 Continue\r\n\r\n')
+        self._flush()
 
     def run_wsgi(self):
         """WSGI 服务器调用 application 响应客户端请求"""
@@ -93,14 +379,26 @@ class RequestsHandler:
                 self.write(data)
 
             if not self.headers_sent:
-                self.headers.setdefault('Content-Length', "0")
+                # HEAD 没有返回数据不代表 GET 的响应体为空
+                if (not _no_body_status(self.status)
+                        and self.request.method != 'HEAD'):
+                    self.headers.setdefault('Content-Length', "0")
                 self.send_headers()
+                self._flush()
+            elif self.chunked and self.request.method != 'HEAD':
+                # 长度为 0 的块表示响应结束
+                self._write(b'0\r\n\r\n')
+                self._flush()
             else:
                 pass  # XXX check if content-length was too short?
-        except Exception:
+
+            if self.trace.sampled:
+                self.trace.mark('write')
+                log(self.trace)
+        finally:
+            # pep3333: 无论是否出错都要调用 app 返回值的 close()
             if hasattr(self.app_result, 'close'):
                 self.app_result.close()
-            raise
 
     def set_content_length(self):
         """设置 `Content-Length`大小， pep3333 规定如下：
@@ -109,7 +407,8 @@ class RequestsHandler:
         那么 WSGI 服务器端就可以自行通过可迭代对象生成的第一个 bytestring 字符串
         来得到这个 Content-Length 的值。
         """
-        if 'Content-Length' in self.headers:
+        if 'Content-Length' in self.headers or _no_body_status(self.status):
+            # 304 的 Content-Length 只能是完整响应的长度，由 app 给出
             return
         try:
             blocks = len(self.app_result)
@@ -120,7 +419,11 @@ class RequestsHandler:
                 self.headers['Content-Length'] = str(self.bytes_sent)
                 return
 
-        # TODO：支持 http chunk 数据传输
+        # 长度未知时 HTTP/1.1 使用 chunked 传输，连接可以继续复用
+        if (self.request.version == 'HTTP/1.1'
+                and 'Transfer-Encoding' not in self.headers):
+            self.headers['Transfer-Encoding'] = 'chunked'
+            self.chunked = True
 
     def send_response_line(self):
         response_line = f'HTTP/1.1 {self.status}\r\n'
@@ -129,6 +432,22 @@ class RequestsHandler:
 
     def send_headers(self):
         self.set_content_length()
+        if (self.headers.get('Connection', '').lower() == 'close'
+                or not (self.chunked or 'Content-Length' in self.headers
+                        or self.request.method == 'HEAD'
+                        or _no_body_status(self.status))):
+            # 没有 Content-Length 时只能靠关闭连接表示响应结束
+            self.close_connection = True
+        if self.input.awaiting_continue():
+            # 没有读取 Expect: 100-continue 的请求体，响应后关闭连接 (RFC 9110 10.1.1)
+            self.close_connection = True
+        if self.close_connection:
+            self.headers['Connection'] = 'close'
+        if self.trace.sampled:
+            self.trace.mark('app')
+            if self.server_timing:
+                self.headers.add_header('Server-Timing',
+                                        self.trace.server_timing())
         self.headers_sent = True
         self.send_response_line()
 
@@ -155,11 +474,28 @@ class RequestsHandler:
             # 计算已发送字节大小 (headers+body)
             self.bytes_sent += len(data)
 
-        self._write(data)
+        if self.request.method == 'HEAD' or _no_body_status(self.status):
+            # HEAD 和 1xx、204、304 响应只有响应头，
+            # 多余的数据会被客户端当成下一个响应的开头
+            pass
+        elif self.chunked:
+            # 空块会被当作响应结束，不发送
+            if data:
+                self._write(b'%x\r\n' % len(data))
+                self._write(data)
+                self._write(b'\r\n')
+        else:
+            self._write(data)
         self._flush()
 
     def _write(self, data):
-        """写入套接字, 真正发送数据的接口"""
+        """写入套接字, 真正发送数据的接口
+
+        第一次写入时设置 write 截止时间，_flush() 发送完后取消，
+        每次发送单独计时，app 生成下一块数据的时间不算在内
+        """
+        if self._timer is None:
+            self.set_deadline('write')
         data_length = self._wfile.write(data)
         if data_length is None or data_length == len(data):
             # 表示数据为空，或者已经全部写入了缓冲
@@ -177,10 +513,16 @@ class RequestsHandler:
 
     def _flush(self):
         self._wfile.flush()
+        self.clear_deadline()
 
     @logged('Connection closed')
     def finish(self):
-        self.app_result = self.headers = self.status = self.env = None
-        self.bytes_sent = 0
-        self.headers_sent = False
+        self.clear_deadline()
+        self.reset()
+        self._wfile.detach()
+        self.input.reset(None, 0)
+        if self.rfile is not None:
+            self.rfile.close()
         self.conn.close()
+        self.conn = self.client_address = self.server = None
+        self.app = self.rfile = None
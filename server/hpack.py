@@ -0,0 +1,369 @@
+"""HPACK 头部压缩 (RFC 7541)，供 HTTP/2 引擎使用"""
+
+from collections import deque
+
+__all__ = ['Encoder', 'Decoder', 'HPACKError']
+
+
+class HPACKError(Exception):
+    """头部块无法解码，属于连接错误 COMPRESSION_ERROR"""
+
+
+# 附录 A 静态表，索引从 1 开始
+STATIC_TABLE = (
+    (':authority', ''), (':method', 'GET'), (':method', 'POST'),
+    (':path', '/'), (':path', '/index.html'), (':scheme', 'http'),
+    (':scheme', 'https'), (':status', '200'), (':status', '204'),
+    (':status', '206'), (':status', '304'), (':status', '400'),
+    (':status', '404'), (':status', '500'), ('accept-charset', ''),
+    ('accept-encoding', 'gzip, deflate'), ('accept-language', ''),
+    ('accept-ranges', ''), ('accept', ''),
+    ('access-control-allow-origin', ''), ('age', ''), ('allow', ''),
+    ('authorization', ''), ('cache-control', ''),
+    ('content-disposition', ''), ('content-encoding', ''),
+    ('content-language', ''), ('content-length', ''),
+    ('content-location', ''), ('content-range', ''), ('content-type', ''),
+    ('cookie', ''), ('date', ''), ('etag', ''), ('expect', ''),
+    ('expires', ''), ('from', ''), ('host', ''), ('if-match', ''),
+    ('if-modified-since', ''), ('if-none-match', ''), ('if-range', ''),
+    ('if-unmodified-since', ''), ('last-modified', ''), ('link', ''),
+    ('location', ''), ('max-forwards', ''), ('proxy-authenticate', ''),
+    ('proxy-authorization', ''), ('range', ''), ('referer', ''),
+    ('refresh', ''), ('retry-after', ''), ('server', ''),
+    ('set-cookie', ''), ('strict-transport-security', ''),
+    ('transfer-encoding', ''), ('user-agent', ''), ('vary', ''),
+    ('via', ''), ('www-authenticate', ''),
+)
+_STATIC_LEN = len(STATIC_TABLE)
+_STATIC_FIELDS = {}
+_STATIC_NAMES = {}
+for _i, (_name, _value) in enumerate(STATIC_TABLE, 1):
+    _STATIC_FIELDS.setdefault((_name, _value), _i)
+    _STATIC_NAMES.setdefault(_name, _i)
+
+# 每个表项的额外开销
+ENTRY_OVERHEAD = 32
+
+
+# 附录 B 霍夫曼编码的码长，下标是字节值，256 是 EOS。
+# 该编码是规范霍夫曼编码，码字可以由码长按 (码长, 符号) 顺序依次生成。
+_HUFFMAN_LENGTHS = (
+    13, 23, 28, 28, 28, 28, 28, 28, 28, 24, 30, 28, 28, 30, 28, 28,
+    28, 28, 28, 28, 28, 28, 30, 28, 28, 28, 28, 28, 28, 28, 28, 28,
+    6, 10, 10, 12, 13, 6, 8, 11, 10, 10, 8, 11, 8, 6, 6, 6,
+    5, 5, 5, 6, 6, 6, 6, 6, 6, 6, 7, 8, 15, 6, 12, 10,
+    13, 6, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7,
+    7, 7, 7, 7, 7, 7, 7, 7, 8, 7, 8, 13, 19, 13, 14, 6,
+    15, 5, 6, 5, 6, 5, 6, 6, 6, 5, 7, 7, 6, 6, 6, 5,
+    6, 7, 6, 5, 5, 6, 7, 7, 7, 7, 7, 15, 11, 14, 13, 28,
+    20, 22, 20, 20, 22, 22, 22, 23, 22, 23, 23, 23, 23, 23, 24, 23,
+    24, 24, 22, 23, 24, 23, 23, 23, 23, 21, 22, 23, 22, 23, 23, 24,
+    22, 21, 20, 22, 22, 23, 23, 21, 23, 22, 22, 24, 21, 22, 23, 23,
+    21, 21, 22, 21, 23, 22, 23, 23, 20, 22, 22, 22, 23, 22, 22, 23,
+    26, 26, 20, 19, 22, 23, 22, 25, 26, 26, 26, 27, 27, 26, 24, 25,
+    19, 21, 26, 27, 27, 26, 27, 24, 21, 21, 26, 26, 28, 27, 27, 27,
+    20, 24, 20, 21, 22, 21, 21, 23, 22, 22, 25, 25, 24, 24, 26, 23,
+    26, 27, 26, 26, 27, 27, 27, 27, 27, 28, 27, 27, 27, 27, 27, 26,
+    30,
+)
+_EOS = 256
+
+
+def _huffman_codes():
+    codes = [0] * len(_HUFFMAN_LENGTHS)
+    code = prev = 0
+    for sym in sorted(range(len(_HUFFMAN_LENGTHS)),
+                      key=lambda s: (_HUFFMAN_LENGTHS[s], s)):
+        length = _HUFFMAN_LENGTHS[sym]
+        code <<= length - prev
+        codes[sym] = code
+        code += 1
+        prev = length
+    return codes
+
+
+_HUFFMAN_CODES = _huffman_codes()
+
+
+def _huffman_decode_table():
+    """按 4 比特为单位解码的状态机
+
+    状态是霍夫曼树的内部节点，表项 (下一状态, 输出符号或 -1, 是否出错)。
+    码长至少 5 比特，所以每 4 比特最多输出一个符号。
+    accept[s] 表示在状态 s 结束是合法的填充 (全 1 且少于 8 比特)。
+    """
+    tree = [[None, None]]  # 内部节点，子节点为 ('node', i) 或 ('sym', s)
+    for sym, code in enumerate(_HUFFMAN_CODES):
+        length = _HUFFMAN_LENGTHS[sym]
+        node = 0
+        for i in range(length - 1, -1, -1):
+            bit = (code >> i) & 1
+            if i == 0:
+                tree[node][bit] = ('sym', sym)
+            else:
+                child = tree[node][bit]
+                if child is None:
+                    tree.append([None, None])
+                    child = tree[node][bit] = ('node', len(tree) - 1)
+                node = child[1]
+
+    accept = [False] * len(tree)
+    accept[0] = True
+    stack = [(0, 0)]  # (节点, 深度)，只沿着 1 的分支走
+    while stack:
+        node, depth = stack.pop()
+        child = tree[node][1]
+        if child[0] == 'node' and depth + 1 < 8:
+            accept[child[1]] = True
+            stack.append((child[1], depth + 1))
+
+    table = []
+    for state in range(len(tree)):
+        for nibble in range(16):
+            node, sym, fail = state, -1, False
+            for i in (3, 2, 1, 0):
+                kind, value = tree[node][(nibble >> i) & 1]
+                if kind == 'node':
+                    node = value
+                elif value == _EOS:
+                    fail = True
+                    break
+                else:
+                    sym, node = value, 0
+            table.append((node, sym, fail))
+    return table, accept
+
+
+_DECODE_TABLE, _DECODE_ACCEPT = _huffman_decode_table()
+
+
+def huffman_encode(data):
+    acc = bits = 0
+    for byte in data:
+        acc = (acc << _HUFFMAN_LENGTHS[byte]) | _HUFFMAN_CODES[byte]
+        bits += _HUFFMAN_LENGTHS[byte]
+    padding = -bits % 8
+    # 用 EOS 的前缀 (全 1) 填充到整字节
+    acc = (acc << padding) | ((1 << padding) - 1)
+    return acc.to_bytes((bits + padding) // 8, 'big')
+
+
+def huffman_length(data):
+    return (sum(_HUFFMAN_LENGTHS[byte] for byte in data) + 7) // 8
+
+
+def huffman_decode(data):
+    table = _DECODE_TABLE
+    out = bytearray()
+    state = 0
+    for byte in data:
+        for nibble in (byte >> 4, byte & 0x0f):
+            state, sym, fail = table[state * 16 + nibble]
+            if fail:
+                raise HPACKError('EOS in huffman string')
+            if sym >= 0:
+                out.append(sym)
+    if not _DECODE_ACCEPT[state]:
+        raise HPACKError('Invalid huffman padding')
+    return bytes(out)
+
+
+def encode_integer(value, prefix_bits, first_byte=0):
+    """整数编码 (5.1)，first_byte 是前缀之前的标志位"""
+    limit = (1 << prefix_bits) - 1
+    if value < limit:
+        return bytes((first_byte | value,))
+    out = bytearray((first_byte | limit,))
+    value -= limit
+    while value >= 128:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def decode_integer(data, pos, prefix_bits):
+    """返回 (整数, 下一个位置)"""
+    limit = (1 << prefix_bits) - 1
+    value = data[pos] & limit
+    pos += 1
+    if value < limit:
+        return value, pos
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise HPACKError('Truncated integer')
+        byte = data[pos]
+        pos += 1
+        value += (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+        if shift > 28:
+            raise HPACKError('Integer too large')
+
+
+class _Table:
+    """静态表 + 动态表，动态表新加入的表项在最前面"""
+
+    def __init__(self, max_size=4096):
+        self.entries = deque()
+        self.size = 0
+        self.max_size = max_size
+
+    def __getitem__(self, index):
+        if 0 < index <= _STATIC_LEN:
+            return STATIC_TABLE[index - 1]
+        try:
+            return self.entries[index - _STATIC_LEN - 1]
+        except IndexError:
+            raise HPACKError(f'Invalid table index {index}') from None
+
+    def add(self, name, value):
+        size = len(name) + len(value) + ENTRY_OVERHEAD
+        self.entries.appendleft((name, value))
+        self.size += size
+        self._evict()
+
+    def resize(self, max_size):
+        self.max_size = max_size
+        self._evict()
+
+    def _evict(self):
+        while self.size > self.max_size and self.entries:
+            name, value = self.entries.pop()
+            self.size -= len(name) + len(value) + ENTRY_OVERHEAD
+
+
+class Decoder:
+    """解码请求头部块，每个连接一个实例，必须按帧到达的顺序解码"""
+
+    def __init__(self, max_table_size=4096):
+        self.table = _Table(max_table_size)
+        # SETTINGS_HEADER_TABLE_SIZE，对端发来的大小更新不能超过这个值
+        self.max_allowed_size = max_table_size
+        self.max_header_list_size = 64 * 1024
+
+    def decode(self, data):
+        """:return: [(name, value)...]，都是 latin-1 解码的 str"""
+        headers = []
+        total = 0
+        pos = 0
+        table = self.table
+        length = len(data)
+        while pos < length:
+            byte = data[pos]
+            if byte & 0x80:
+                # 6.1 索引表示
+                index, pos = decode_integer(data, pos, 7)
+                if index == 0:
+                    raise HPACKError('Index 0')
+                name, value = table[index]
+            elif byte & 0xe0 == 0x20:
+                # 6.3 动态表大小更新
+                size, pos = decode_integer(data, pos, 5)
+                if size > self.max_allowed_size:
+                    raise HPACKError('Table size update too large')
+                table.resize(size)
+                continue
+            else:
+                if byte & 0x40:
+                    # 6.2.1 带索引的字面量
+                    prefix, indexing = 6, True
+                else:
+                    # 6.2.2 / 6.2.3 不索引、永不索引的字面量
+                    prefix, indexing = 4, False
+                index, pos = decode_integer(data, pos, prefix)
+                if index:
+                    name = table[index][0]
+                else:
+                    name, pos = self._string(data, pos)
+                value, pos = self._string(data, pos)
+                if indexing:
+                    table.add(name, value)
+
+            total += len(name) + len(value) + ENTRY_OVERHEAD
+            if total > self.max_header_list_size:
+                raise HPACKError('Header list too large')
+            headers.append((name, value))
+        return headers
+
+    @staticmethod
+    def _string(data, pos):
+        if pos >= len(data):
+            raise HPACKError('Truncated string')
+        huffman = data[pos] & 0x80
+        length, pos = decode_integer(data, pos, 7)
+        end = pos + length
+        if end > len(data):
+            raise HPACKError('Truncated string')
+        raw = data[pos:end]
+        if huffman:
+            raw = huffman_decode(raw)
+        return str(raw, 'latin-1'), end
+
+
+class Encoder:
+    """编码响应头部块，每个连接一个实例，必须按帧发送的顺序编码"""
+
+    # 这些头的值每次都不同或者敏感，不放入动态表
+    never_index = frozenset(('set-cookie', 'authorization', 'cookie'))
+    no_index = frozenset((':path', 'content-length', 'date', 'etag',
+                          'last-modified', 'location', 'server-timing'))
+
+    def __init__(self, max_table_size=4096):
+        self.table = _Table(max_table_size)
+        self._pending_resize = None
+
+    def resize(self, max_size):
+        """对端的 SETTINGS_HEADER_TABLE_SIZE 变化，下一个头部块里通知对端"""
+        max_size = min(max_size, 4096)
+        if max_size != self.table.max_size:
+            self.table.resize(max_size)
+            self._pending_resize = max_size
+
+    def encode(self, headers):
+        """:param headers: [(name, value)...]，name 必须是小写"""
+        out = bytearray()
+        if self._pending_resize is not None:
+            out += encode_integer(self._pending_resize, 5, 0x20)
+            self._pending_resize = None
+
+        for name, value in headers:
+            index, name_index = self._search(name, value)
+            if index:
+                out += encode_integer(index, 7, 0x80)
+                continue
+
+            if name in self.never_index:
+                out += encode_integer(name_index, 4, 0x10)
+            elif name in self.no_index:
+                out += encode_integer(name_index, 4, 0x00)
+            else:
+                out += encode_integer(name_index, 6, 0x40)
+                self.table.add(name, value)
+            if not name_index:
+                out += self._string(name)
+            out += self._string(value)
+        return bytes(out)
+
+    def _search(self, name, value):
+        """返回 (完全匹配的索引, 名字匹配的索引)，没有为 0"""
+        index = _STATIC_FIELDS.get((name, value))
+        if index:
+            return index, index
+        name_index = _STATIC_NAMES.get(name, 0)
+        for i, entry in enumerate(self.table.entries, _STATIC_LEN + 1):
+            if entry[0] == name:
+                if entry[1] == value:
+                    return i, i
+                name_index = name_index or i
+        return 0, name_index
+
+    @staticmethod
+    def _string(value):
+        raw = value.encode('latin-1')
+        if huffman_length(raw) < len(raw):
+            raw = huffman_encode(raw)
+            return encode_integer(len(raw), 7, 0x80) + raw
+        return encode_integer(len(raw), 7) + raw
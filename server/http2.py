@@ -0,0 +1,894 @@
+"""HTTP/2 明文 (h2c prior knowledge) 引擎
+
+    server = make_server(app=app, HandlerClass=H2CHandler)
+
+客户端不经过 Upgrade 直接发送 HTTP/2 连接前言 (如 curl --http2-prior-knowledge,
+gRPC 的明文通道)，H2CHandler 在连接的第一个请求上识别出前言后交给
+H2Connection 处理，其他连接仍按 HTTP/1.x 处理。
+
+一个连接上的多个流并发执行：连接线程只负责读帧、解码头部和分发，
+每个流在共用的线程池里调用一次 WSGI app，响应帧在写锁保护下交错写回同一个套接字。
+一个连接最多同时占用 max_stream_workers 个工作线程，其余的流在连接内排队。
+"""
+
+import queue
+import selectors
+import socket
+import struct
+import threading
+import time
+import traceback
+from collections import deque
+from functools import partial
+
+from server.handler import RequestsHandler, _no_body_status
+from server.hpack import Encoder, Decoder, HPACKError
+from server.request import Request
+from server.environ import setup_environ
+from server.stream import ClientDisconnected
+from server.tracing import NULL_TRACE
+from server.utils import log, format_date_time
+
+__all__ = ['H2CHandler', 'H2Connection']
+
+
+# 请求行 "PRI * HTTP/2.0" 和空行之后剩余的连接前言
+PREFACE_TAIL = b'SM\r\n\r\n'
+
+# 帧类型
+DATA = 0x0
+HEADERS = 0x1
+PRIORITY = 0x2
+RST_STREAM = 0x3
+SETTINGS = 0x4
+PUSH_PROMISE = 0x5
+PING = 0x6
+GOAWAY = 0x7
+WINDOW_UPDATE = 0x8
+CONTINUATION = 0x9
+
+# 帧标志
+FLAG_END_STREAM = 0x1
+FLAG_ACK = 0x1
+FLAG_END_HEADERS = 0x4
+FLAG_PADDED = 0x8
+FLAG_PRIORITY = 0x20
+
+# SETTINGS 参数
+SETTINGS_HEADER_TABLE_SIZE = 0x1
+SETTINGS_ENABLE_PUSH = 0x2
+SETTINGS_MAX_CONCURRENT_STREAMS = 0x3
+SETTINGS_INITIAL_WINDOW_SIZE = 0x4
+SETTINGS_MAX_FRAME_SIZE = 0x5
+SETTINGS_MAX_HEADER_LIST_SIZE = 0x6
+
+# 错误码
+NO_ERROR = 0x0
+PROTOCOL_ERROR = 0x1
+INTERNAL_ERROR = 0x2
+FLOW_CONTROL_ERROR = 0x3
+STREAM_CLOSED = 0x5
+FRAME_SIZE_ERROR = 0x6
+REFUSED_STREAM = 0x7
+CANCEL = 0x8
+COMPRESSION_ERROR = 0x9
+ENHANCE_YOUR_CALM = 0xb
+
+DEFAULT_WINDOW_SIZE = 65535
+DEFAULT_FRAME_SIZE = 16384
+MAX_WINDOW_SIZE = 2 ** 31 - 1
+
+_frame_header = struct.Struct('>HBBBL')  # 24 位长度拆成 16 + 8 位
+
+# HTTP/2 禁止的连接相关响应头
+_CONNECTION_HEADERS = frozenset((
+    'connection', 'keep-alive', 'proxy-connection', 'transfer-encoding',
+    'upgrade',
+))
+
+
+class ProtocolError(Exception):
+    """连接错误，发送 GOAWAY 后关闭连接"""
+
+    def __init__(self, code, message=''):
+        super().__init__(message)
+        self.code = code
+
+
+def frame(type_, flags, stream_id, payload=b''):
+    length = len(payload)
+    return _frame_header.pack(length >> 8, length & 0xff, type_, flags,
+                              stream_id) + payload
+
+
+class StreamInput:
+    """一个流的 wsgi.input
+
+    连接线程收到 DATA 帧后 feed()，app 在工作线程里阻塞读取。
+    app 读走多少数据就给对端发送多少流窗口，缓冲区最多一个窗口大小。
+    和 InputStream 一样，每次阻塞等待前后调用 deadline(True/False)，
+    超时由连接重置这个流，feed_eof() 唤醒等待的 app。
+    """
+
+    def __init__(self, consumed, deadline=None):
+        self._buffer = bytearray()
+        self._cond = threading.Condition(threading.Lock())
+        self._eof = False
+        self._error = None
+        self._consumed = consumed  # consumed(n) 归还流量控制窗口
+        self._deadline = deadline
+
+    def _wait(self, ready):
+        """在锁内等待直到 ready() 为真，等待期间启用读取超时"""
+        if ready():
+            return
+        if self._deadline is not None:
+            self._deadline(True)
+        try:
+            while not ready():
+                self._cond.wait()
+        finally:
+            if self._deadline is not None:
+                self._deadline(False)
+
+    def feed(self, data):
+        with self._cond:
+            self._buffer += data
+            self._cond.notify_all()
+
+    def feed_eof(self, error=None):
+        with self._cond:
+            self._eof = True
+            self._error = error
+            self._cond.notify_all()
+
+    def _take(self, size):
+        """在锁内等待数据，取出已到达的最多 size 字节，size < 0 时全部取出"""
+        buffer = self._buffer
+        self._wait(lambda: self._eof or buffer)
+        if self._error is not None and not buffer:
+            raise ClientDisconnected(self._error)
+        if size < 0 or size >= len(buffer):
+            data = bytes(buffer)
+            buffer.clear()
+        else:
+            data = bytes(buffer[:size])
+            del buffer[:size]
+        return data
+
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+        # 每取出一段就归还窗口，对端才能继续发送，否则读到结束会死锁
+        parts = []
+        while size:
+            with self._cond:
+                data = self._take(size)
+            if not data:
+                break
+            self._consumed(len(data))
+            parts.append(data)
+            if size > 0:
+                size -= len(data)
+        return b''.join(parts)
+
+    def readline(self, size=-1):
+        if size is None:
+            size = -1
+        buffer = self._buffer
+        with self._cond:
+            # 缓冲区满一个窗口时对端不会再发送，只能返回不完整的行
+            self._wait(lambda: (b'\n' in buffer or self._eof
+                                or 0 <= size <= len(buffer)
+                                or len(buffer) >= DEFAULT_WINDOW_SIZE))
+            end = buffer.find(b'\n') + 1
+            if end and (size < 0 or end <= size):
+                size = end
+            data = self._take(size)
+        if data:
+            self._consumed(len(data))
+        return data
+
+    def readlines(self, hint=-1):
+        lines = []
+        total = 0
+        for line in self:
+            lines.append(line)
+            total += len(line)
+            if 0 < hint <= total:
+                break
+        return lines
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+
+class Stream:
+    __slots__ = ('id', 'input', 'send_window', 'recv_window', 'reset',
+                 'remote_closed', 'request', 'started', 'timer')
+
+    def __init__(self, stream_id, connection):
+        self.id = stream_id
+        self.input = StreamInput(partial(connection.stream_consumed, self),
+                                 partial(connection.body_deadline, self))
+        self.send_window = connection.peer_initial_window
+        self.recv_window = DEFAULT_WINDOW_SIZE
+        self.reset = False  # 对端发送了 RST_STREAM 或连接已关闭
+        self.remote_closed = False  # 对端已发送 END_STREAM
+        self.request = None
+        self.started = time.monotonic()  # 收到头部块的时间
+        self.timer = None  # 请求体读取超时的定时器
+
+
+class _WorkerPool:
+    """所有连接共用的流工作线程
+
+    和 ThreadingMixIn.daemon_threads 一样使用守护线程，阻塞在 app 里的流
+    不会妨碍进程退出。线程按需创建，最多 size 个。
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._tasks = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._threads = 0
+        self._idle = 0
+
+    def submit(self, func, *args):
+        with self._lock:
+            if self._idle:
+                self._idle -= 1
+            elif self._threads < self.size:
+                self._threads += 1
+                threading.Thread(target=self._work, daemon=True,
+                                 name=f'h2-stream-{self._threads}').start()
+        self._tasks.put((func, args))
+
+    def _work(self):
+        while True:
+            func, args = self._tasks.get()
+            try:
+                func(*args)
+            except Exception:
+                traceback.print_exc()
+            with self._lock:
+                self._idle += 1
+
+
+class H2Connection:
+    """一个 HTTP/2 连接的状态机，由 H2CHandler 在连接线程里调用 run()"""
+    max_concurrent_streams = 100
+    max_workers = 32  # 所有连接共用的线程池大小
+    max_stream_workers = 8  # 一个连接最多同时占用的工作线程数
+    # 除了正在处理完整请求的流，超过该秒数没有收到帧则关闭连接，
+    # 只打开流、不发送请求体的客户端也会超时
+    idle_timeout = 60
+    poll_interval = 1  # 检查空闲超时的间隔
+    max_header_block = 64 * 1024  # HEADERS 加 CONTINUATION 的头部块上限
+    linger = 1  # 连接错误时等待客户端读取 GOAWAY 的秒数
+    recv_size = 64 * 1024
+
+    _workers = None
+    _workers_lock = threading.Lock()
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.conn = handler.conn
+        self.app = handler.app
+        self.streams = {}
+        self.last_stream_id = 0
+        self.closed = False
+        self.goaway = False  # 对端发送了 GOAWAY，不再接受新的流
+
+        self.encoder = Encoder()
+        self.decoder = Decoder()
+        self.peer_window = DEFAULT_WINDOW_SIZE  # 连接级发送窗口
+        self.peer_initial_window = DEFAULT_WINDOW_SIZE
+        self.peer_frame_size = DEFAULT_FRAME_SIZE
+
+        # 流量控制窗口、流表的状态变化都在 _cond 上通知
+        self._cond = threading.Condition(threading.Lock())
+        # 保证帧完整地写入套接字，HPACK 编码顺序和发送顺序一致
+        self._write_lock = threading.Lock()
+        self._buffer = bytearray()
+        self._selector = None
+        self._headers_block = None  # 等待 CONTINUATION 的 (流, 标志, 头部块)
+        self._running = 0  # 占用工作线程的流数
+        self._pending = deque()  # 超过 max_stream_workers 后排队的流
+
+    @classmethod
+    def workers(cls):
+        if cls._workers is None:
+            with cls._workers_lock:
+                if cls._workers is None:
+                    cls._workers = _WorkerPool(cls.max_workers)
+        return cls._workers
+
+    def run(self, data=b''):
+        """:param data: 连接读文件里已经缓冲的、前言之后的字节"""
+        self._buffer += data
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self.conn, selectors.EVENT_READ)
+        self.send(frame(SETTINGS, 0, 0, struct.pack(
+            '>HL', SETTINGS_MAX_CONCURRENT_STREAMS,
+            self.max_concurrent_streams)))
+        code = NO_ERROR
+        try:
+            while True:
+                header = self._read_frame()
+                if header is None:
+                    break
+                self.dispatch(*header)
+        except ProtocolError as e:
+            log(f'HTTP/2 connection error {e.code}: {e}')
+            code = e.code
+        except HPACKError as e:
+            log(f'HTTP/2 compression error: {e}')
+            code = COMPRESSION_ERROR
+        except OSError:
+            # 客户端断开
+            pass
+        finally:
+            self.close(code)
+            self._selector.close()
+
+    def _read_frame(self):
+        header = self._read(9)
+        if header is None:
+            return None
+        high, low, type_, flags, stream_id = _frame_header.unpack(header)
+        length = (high << 8) | low
+        if length > DEFAULT_FRAME_SIZE:
+            # 没有调整 SETTINGS_MAX_FRAME_SIZE，对端不能发送更大的帧
+            raise ProtocolError(FRAME_SIZE_ERROR, 'Frame too large')
+        payload = self._read(length)
+        if payload is None:
+            return None
+        return type_, flags, stream_id & MAX_WINDOW_SIZE, payload
+
+    def _read(self, n):
+        """读取 n 字节，连接关闭或空闲超时时返回 None
+
+        直接 recv 而不用 makefile 的读文件，每 poll_interval 秒检查一次空闲时间
+        """
+        buffer = self._buffer
+        last = time.monotonic()
+        while len(buffer) < n:
+            if not self._selector.select(self.poll_interval):
+                with self._cond:
+                    # 还在等待请求体的流不算活动
+                    active = any(stream.remote_closed and not stream.reset
+                                 for stream in self.streams.values())
+                now = time.monotonic()
+                if active:
+                    last = now
+                elif now - last >= self.idle_timeout:
+                    return None
+                continue
+            chunk = self.conn.recv(self.recv_size)
+            if not chunk:
+                return None
+            buffer += chunk
+            last = time.monotonic()
+        data = bytes(buffer[:n])
+        del buffer[:n]
+        return data
+
+    def send(self, data):
+        with self._write_lock:
+            self.conn.sendall(data)
+
+    def dispatch(self, type_, flags, stream_id, payload):
+        if self._headers_block is not None and type_ != CONTINUATION:
+            raise ProtocolError(PROTOCOL_ERROR, 'Expected CONTINUATION')
+
+        if type_ == DATA:
+            self.on_data(flags, stream_id, payload)
+        elif type_ == HEADERS:
+            self.on_headers(flags, stream_id, payload)
+        elif type_ == CONTINUATION:
+            block = self._headers_block
+            if block is None or block[0] != stream_id:
+                raise ProtocolError(PROTOCOL_ERROR,
+                                       'Unexpected CONTINUATION')
+            if len(block[2]) + len(payload) > self.max_header_block:
+                raise ProtocolError(ENHANCE_YOUR_CALM, 'Header block too large')
+            block[2].extend(payload)
+            if flags & FLAG_END_HEADERS:
+                self._headers_block = None
+                self.on_header_block(block[0], block[1], bytes(block[2]))
+        elif type_ == SETTINGS:
+            self.on_settings(flags, stream_id, payload)
+        elif type_ == WINDOW_UPDATE:
+            self.on_window_update(stream_id, payload)
+        elif type_ == PING:
+            if len(payload) != 8 or stream_id:
+                raise ProtocolError(FRAME_SIZE_ERROR, 'Invalid PING')
+            if not flags & FLAG_ACK:
+                self.send(frame(PING, FLAG_ACK, 0, payload))
+        elif type_ == RST_STREAM:
+            if len(payload) != 4 or not stream_id:
+                raise ProtocolError(PROTOCOL_ERROR, 'Invalid RST_STREAM')
+            self.reset_stream(stream_id, 'Stream reset by client')
+        elif type_ == GOAWAY:
+            self.goaway = True
+        elif type_ == PUSH_PROMISE:
+            raise ProtocolError(PROTOCOL_ERROR, 'Client sent PUSH_PROMISE')
+        # PRIORITY 和未知类型的帧直接忽略
+
+    @staticmethod
+    def _strip_padding(flags, payload):
+        if not flags & FLAG_PADDED:
+            return payload
+        if not payload or payload[0] >= len(payload):
+            raise ProtocolError(PROTOCOL_ERROR, 'Invalid padding')
+        return payload[1:len(payload) - payload[0]]
+
+    def on_data(self, flags, stream_id, payload):
+        if not stream_id:
+            raise ProtocolError(PROTOCOL_ERROR, 'DATA on stream 0')
+        data = self._strip_padding(flags, payload)
+        # 连接级窗口立即归还，每个流的缓冲受各自的流窗口限制
+        if payload:
+            self.send(frame(WINDOW_UPDATE, 0, 0,
+                            struct.pack('>L', len(payload))))
+
+        with self._cond:
+            stream = self.streams.get(stream_id)
+        if stream is None or stream.remote_closed:
+            # 已经响应完的流，客户端还在发送请求体，直接丢弃
+            if stream_id > self.last_stream_id:
+                raise ProtocolError(PROTOCOL_ERROR, 'DATA on idle stream')
+            return
+
+        with self._cond:
+            stream.recv_window -= len(payload)
+            exceeded = stream.recv_window < 0
+        if exceeded:
+            self.send_reset(stream_id, FLOW_CONTROL_ERROR)
+            self.reset_stream(stream_id, 'Flow control window exceeded')
+            return
+        padding = len(payload) - len(data)
+        if padding:
+            self.stream_consumed(stream, padding)
+        if data:
+            stream.input.feed(data)
+        if flags & FLAG_END_STREAM:
+            stream.remote_closed = True
+            stream.input.feed_eof()
+
+    def on_headers(self, flags, stream_id, payload):
+        if not stream_id % 2:
+            raise ProtocolError(PROTOCOL_ERROR, 'Invalid stream id')
+        payload = self._strip_padding(flags, payload)
+        if flags & FLAG_PRIORITY:
+            payload = payload[5:]
+        if flags & FLAG_END_HEADERS:
+            self.on_header_block(stream_id, flags, payload)
+        else:
+            self._headers_block = (stream_id, flags, bytearray(payload))
+
+    def on_header_block(self, stream_id, flags, block):
+        # 即使拒绝这个流，也要解码以保持 HPACK 动态表同步
+        headers = self.decoder.decode(block)
+
+        with self._cond:
+            stream = self.streams.get(stream_id)
+            active = len(self.streams)
+        if stream is not None:
+            # 请求体之后的 trailers，忽略内容，只表示请求结束
+            if not flags & FLAG_END_STREAM:
+                raise ProtocolError(PROTOCOL_ERROR,
+                                       'Trailers without END_STREAM')
+            stream.remote_closed = True
+            stream.input.feed_eof()
+            return
+        if stream_id <= self.last_stream_id:
+            # 已经结束的流，头部块解码后丢弃
+            return
+        self.last_stream_id = stream_id
+
+        if self.goaway or active >= self.max_concurrent_streams:
+            self.send_reset(stream_id, REFUSED_STREAM)
+            return
+        request = self.make_request(headers)
+        if request is None:
+            self.send_reset(stream_id, PROTOCOL_ERROR)
+            return
+
+        with self._cond:
+            stream = Stream(stream_id, self)
+            self.streams[stream_id] = stream
+        stream.request = request
+        if flags & FLAG_END_STREAM:
+            stream.remote_closed = True
+            stream.input.feed_eof()
+        with self._cond:
+            if self._running >= self.max_stream_workers:
+                self._pending.append(stream)
+                return
+            self._running += 1
+        self.workers().submit(self.run_streams, stream)
+
+    @staticmethod
+    def make_request(headers):
+        """伪头部和普通头部转换成 HTTP/1 的 Request，缺少必需的伪头部时返回 None"""
+        request = Request()
+        pseudo = {}
+        cookies = []
+        for name, value in headers:
+            if name.startswith(':'):
+                pseudo[name] = value
+            elif name == 'cookie':
+                # 拆分发送的 cookie 要合并成一个 (RFC 7540 8.1.2.5)
+                cookies.append(value)
+            else:
+                request.header.add_header(name, value)
+        if cookies:
+            request.header.add_header('cookie', '; '.join(cookies))
+
+        method, path = pseudo.get(':method'), pseudo.get(':path')
+        if not method or not path or ':scheme' not in pseudo:
+            return None
+        authority = pseudo.get(':authority')
+        if authority and 'host' not in request.header:
+            request.header.add_header('host', authority)
+
+        request.method = method
+        request.path, _, query = path.partition('?')
+        request.query_string = query or None
+        request.version = 'HTTP/2.0'
+        request._request_line = f'{method} {path} HTTP/2.0'
+        return request
+
+    def on_settings(self, flags, stream_id, payload):
+        if stream_id:
+            raise ProtocolError(PROTOCOL_ERROR, 'SETTINGS on a stream')
+        if flags & FLAG_ACK:
+            return
+        if len(payload) % 6:
+            raise ProtocolError(FRAME_SIZE_ERROR, 'Invalid SETTINGS')
+
+        for i in range(0, len(payload), 6):
+            key, value = struct.unpack_from('>HL', payload, i)
+            if key == SETTINGS_HEADER_TABLE_SIZE:
+                with self._write_lock:
+                    self.encoder.resize(value)
+            elif key == SETTINGS_INITIAL_WINDOW_SIZE:
+                if value > MAX_WINDOW_SIZE:
+                    raise ProtocolError(FLOW_CONTROL_ERROR,
+                                           'Window too large')
+                with self._cond:
+                    # 新的初始窗口大小按差值调整所有已打开的流
+                    delta = value - self.peer_initial_window
+                    self.peer_initial_window = value
+                    for stream in self.streams.values():
+                        stream.send_window += delta
+                    self._cond.notify_all()
+            elif key == SETTINGS_MAX_FRAME_SIZE:
+                if not DEFAULT_FRAME_SIZE <= value <= 2 ** 24 - 1:
+                    raise ProtocolError(PROTOCOL_ERROR,
+                                           'Invalid max frame size')
+                self.peer_frame_size = value
+        self.send(frame(SETTINGS, FLAG_ACK, 0))
+
+    def on_window_update(self, stream_id, payload):
+        if len(payload) != 4:
+            raise ProtocolError(FRAME_SIZE_ERROR, 'Invalid WINDOW_UPDATE')
+        increment = struct.unpack('>L', payload)[0] & MAX_WINDOW_SIZE
+        if not increment:
+            if not stream_id:
+                raise ProtocolError(PROTOCOL_ERROR, 'Zero window update')
+            self.send_reset(stream_id, PROTOCOL_ERROR)
+            self.reset_stream(stream_id, 'Zero window update')
+            return
+        with self._cond:
+            if not stream_id:
+                self.peer_window += increment
+                if self.peer_window > MAX_WINDOW_SIZE:
+                    raise ProtocolError(FLOW_CONTROL_ERROR,
+                                           'Window overflow')
+            else:
+                stream = self.streams.get(stream_id)
+                if stream is None:
+                    return
+                stream.send_window += increment
+            self._cond.notify_all()
+
+    def stream_consumed(self, stream, n):
+        """app 读取了 n 字节请求体，归还流窗口"""
+        if stream.remote_closed or stream.reset:
+            return
+        with self._cond:
+            stream.recv_window += n
+        try:
+            self.send(frame(WINDOW_UPDATE, 0, stream.id, struct.pack('>L', n)))
+        except OSError:
+            pass
+
+    def send_reset(self, stream_id, code):
+        self.send(frame(RST_STREAM, 0, stream_id, struct.pack('>L', code)))
+
+    def reset_stream(self, stream_id, reason):
+        with self._cond:
+            stream = self.streams.get(stream_id)
+            if stream is None:
+                return
+            stream.reset = True
+            self._cond.notify_all()
+        stream.input.feed_eof(reason)
+
+    def body_deadline(self, stream, active):
+        """app 阻塞读取请求体前后调用，和 RequestsHandler 共用 body_timeout"""
+        wheel = self.handler.server.timer_wheel
+        if stream.timer is not None:
+            wheel.cancel(stream.timer)
+            stream.timer = None
+        if active:
+            stream.timer = wheel.schedule(self.handler.body_timeout,
+                                          partial(self._expire_stream, stream))
+
+    def _expire_stream(self, stream):
+        """时间轮线程里调用，请求体超时则重置流，释放阻塞的工作线程"""
+        if stream.reset or stream.remote_closed:
+            return
+        log(f'HTTP/2 stream {stream.id} timed out reading the request body')
+        try:
+            self.send_reset(stream.id, CANCEL)
+        except OSError:
+            pass
+        self.reset_stream(stream.id, 'Request body timed out')
+
+    def close(self, code=NO_ERROR):
+        """发送 GOAWAY，通知所有流结束，等待正在执行的 app 返回"""
+        with self._cond:
+            self.closed = True
+            streams = list(self.streams.values())
+            self._cond.notify_all()
+        for stream in streams:
+            stream.input.feed_eof('Connection closed')
+        try:
+            self.send(frame(GOAWAY, 0, 0, struct.pack(
+                '>LL', self.last_stream_id, code)))
+        except OSError:
+            pass
+        deadline = time.monotonic() + self.handler.write_timeout
+        with self._cond:
+            while self.streams:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+        if code != NO_ERROR:
+            self._linger()
+
+    def _linger(self):
+        """关闭写端后读掉客户端还在发送的帧
+
+        直接关闭时未读的数据会触发 RST，客户端可能收不到 GOAWAY
+        """
+        deadline = time.monotonic() + self.linger
+        try:
+            self.conn.shutdown(socket.SHUT_WR)
+            self.conn.settimeout(self.linger)
+            while time.monotonic() < deadline:
+                if not self.conn.recv(self.recv_size):
+                    break
+        except OSError:
+            pass
+
+    # 以下方法在工作线程里执行
+
+    def run_streams(self, stream):
+        """执行一个流，然后接着执行本连接排队的流"""
+        while stream is not None:
+            self.run_stream(stream)
+            with self._cond:
+                if self._pending:
+                    stream = self._pending.popleft()
+                else:
+                    self._running -= 1
+                    stream = None
+
+    def run_stream(self, stream):
+        if self.closed or stream.reset:
+            # 排队期间连接已关闭或流已被重置
+            with self._cond:
+                self.streams.pop(stream.id, None)
+                self._cond.notify_all()
+            return
+        request = stream.request
+        log(request)
+        env = setup_environ(request, self.handler.server,
+                            self.handler.client_address)
+        env['wsgi.input'] = stream.input
+        env['server.trace'] = NULL_TRACE
+        env['server.started'] = stream.started
+        response = _StreamResponse(self, stream)
+        try:
+            result = self.app(env, response.start_response)
+            try:
+                for data in result:
+                    response.write(data)
+                response.finish()
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        except OSError:
+            # 包括 ClientDisconnected，客户端重置了流或断开了连接
+            pass
+        except Exception:
+            traceback.print_exc()
+            try:
+                response.abort()
+            except OSError:
+                pass
+        finally:
+            with self._cond:
+                self.streams.pop(stream.id, None)
+                self._cond.notify_all()
+            if not stream.remote_closed and not stream.reset:
+                # 响应已经结束，不再需要剩余的请求体
+                try:
+                    self.send_reset(stream.id, NO_ERROR)
+                except OSError:
+                    pass
+
+    def send_headers(self, stream, status, headers, end_stream):
+        fields = [(':status', status[:3])]
+        for name, value in headers:
+            name = name.lower()
+            if name not in _CONNECTION_HEADERS:
+                fields.append((name, value))
+        if 'date' not in (name for name, _ in fields):
+            fields.append(('date', format_date_time(time.time())))
+
+        flags = FLAG_END_STREAM if end_stream else 0
+        with self._write_lock:
+            block = self.encoder.encode(fields)
+            size = self.peer_frame_size
+            first, block = block[:size], block[size:]
+            frames = [frame(HEADERS, flags | (0 if block else FLAG_END_HEADERS),
+                            stream.id, first)]
+            while block:
+                chunk, block = block[:size], block[size:]
+                frames.append(frame(CONTINUATION,
+                                    0 if block else FLAG_END_HEADERS,
+                                    stream.id, chunk))
+            self.conn.sendall(b''.join(frames))
+
+    def send_data(self, stream, data, end_stream=False):
+        """按连接和流的发送窗口分帧发送，窗口用完时等待 WINDOW_UPDATE"""
+        view = memoryview(data)
+        while True:
+            n = self._reserve_window(stream, len(view))
+            if n is None:
+                # 和 HTTP/1 的写超时一样，对端长时间不归还窗口就放弃这个流
+                self.send_reset(stream.id, CANCEL)
+                self.reset_stream(stream.id, 'Flow control window timed out')
+                raise ClientDisconnected('Flow control window timed out')
+            chunk, view = view[:n], view[n:]
+            last = end_stream and not view
+            self.send(frame(DATA, FLAG_END_STREAM if last else 0, stream.id,
+                            bytes(chunk)))
+            if not view:
+                return
+
+    def _reserve_window(self, stream, size):
+        """从发送窗口里预留最多 size 字节，等待超过 write_timeout 返回 None"""
+        deadline = time.monotonic() + self.handler.write_timeout
+        with self._cond:
+            while size and not (self.closed or stream.reset) and (
+                    self.peer_window <= 0 or stream.send_window <= 0):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+            if self.closed or stream.reset:
+                raise ClientDisconnected('Stream closed by client')
+            # SETTINGS 调小初始窗口后流窗口可能为负，结束流的空帧不能归还窗口
+            n = max(0, min(size, self.peer_window, stream.send_window,
+                           self.peer_frame_size))
+            self.peer_window -= n
+            stream.send_window -= n
+        return n
+
+
+class _StreamResponse:
+    """一个流的 start_response/write，接口和 RequestsHandler 的一致"""
+    __slots__ = ('connection', 'stream', 'status', 'headers', 'headers_sent',
+                 'has_body')
+
+    def __init__(self, connection, stream):
+        self.connection = connection
+        self.stream = stream
+        self.status = self.headers = None
+        self.headers_sent = False
+        self.has_body = True
+
+    def start_response(self, status, response_headers, exc_info=None):
+        if exc_info:
+            try:
+                if self.headers_sent:
+                    raise exc_info[0](exc_info[1]).with_traceback(exc_info[2])
+            finally:
+                exc_info = None
+        elif self.headers is not None:
+            raise AssertionError("Headers already set!")
+        assert isinstance(status, str), '`status` must be a str instance'
+        self.status = status
+        self.headers = response_headers
+        return self.write
+
+    def write(self, data):
+        assert isinstance(data, bytes), '`write(data) data must be a bytes'
+        if not self.status:
+            raise AssertionError('write(data) before `start_response`')
+        if not self.headers_sent:
+            self.headers_sent = True
+            # HEAD 和 204、304 只发送响应头，app 返回的数据丢弃
+            self.has_body = not (self.stream.request.method == 'HEAD'
+                                 or _no_body_status(self.status))
+            self.connection.send_headers(self.stream, self.status,
+                                         self.headers, not self.has_body)
+        if data and self.has_body:
+            self.connection.send_data(self.stream, data)
+
+    def finish(self):
+        if not self.has_body:
+            return
+        if not self.headers_sent:
+            # 没有响应体，HEADERS 帧直接结束流
+            self.headers_sent = True
+            self.connection.send_headers(self.stream, self.status,
+                                         self.headers, True)
+        else:
+            self.connection.send_data(self.stream, b'', end_stream=True)
+
+    def abort(self):
+        """app 出错时，还没发送响应头则返回 500，否则重置流"""
+        if self.headers_sent:
+            if self.has_body:
+                # 没有响应体时 HEADERS 帧已经结束了流
+                self.connection.send_reset(self.stream.id, INTERNAL_ERROR)
+        else:
+            self.headers_sent = True
+            self.connection.send_headers(
+                self.stream, '500 Internal Server Error',
+                [('content-length', '0')], True)
+
+
+class H2CHandler(RequestsHandler):
+    """支持 h2c prior knowledge 的连接处理，其他请求仍按 HTTP/1.x 处理"""
+    __slots__ = ()
+    connection_class = H2Connection
+
+    def handle(self):
+        request = self.request
+        if request.method != 'PRI' or request.version != 'HTTP/2.0':
+            return super().handle()
+
+        self.close_connection = True
+        # 前言只能出现在连接开头，keep-alive 之后的 PRI 请求直接关闭连接
+        if (self._accepted is None
+                or self.rfile.read(len(PREFACE_TAIL)) != PREFACE_TAIL):
+            return
+        log('<Request HTTP/2 connection preface>')
+        # HTTP/2 连接由 H2Connection 自己管理空闲超时
+        self.clear_deadline()
+        self.connection_class(self).run(self._buffered())
+
+    def _buffered(self):
+        """取出读文件缓冲区里已有的字节，之后直接从套接字读取"""
+        self.conn.setblocking(False)
+        try:
+            data = self.rfile.peek()
+        finally:
+            self.conn.settimeout(self.socket_timeout())
+        return self.rfile.read(len(data)) if data else b''
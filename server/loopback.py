@@ -0,0 +1,199 @@
+"""内存回环连接，不经过套接字重放 HTTP 请求，用于请求处理流程的基准测试
+
+    python -m server.loopback request.http -n 100000 --app app:app
+
+request.http 是录制的原始请求字节流，可以包含多个 keep-alive 请求。
+"""
+
+import io
+import gc
+import socket
+import argparse
+import importlib
+import tracemalloc
+from collections import defaultdict
+from time import perf_counter
+
+from server import utils
+from server.handler import RequestsHandler
+from server.pool import Pool
+from server.timer import TimerWheel
+
+__all__ = ['LoopbackConnection', 'LoopbackServer', 'replay']
+
+
+class LoopbackConnection:
+    """实现 RequestsHandler 用到的套接字接口，读取给定的字节，写入丢弃或保存"""
+    __slots__ = ('data', 'output', 'sent', 'keep_output', 'closed')
+    family = socket.AF_INET
+
+    def __init__(self, data, keep_output=False):
+        self.data = data
+        self.output = bytearray()
+        self.sent = 0  # 已发送的字节数
+        self.keep_output = keep_output
+        self.closed = False
+
+    def makefile(self, mode='rb', *args, **kwargs):
+        return io.BytesIO(self.data)
+
+    def sendall(self, data):
+        with memoryview(data) as view:
+            self.sent += view.nbytes
+            if self.keep_output:
+                self.output += view
+
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def settimeout(self, timeout):
+        pass
+
+    def setblocking(self, flag):
+        pass
+
+    def setsockopt(self, *args):
+        pass
+
+    def fileno(self):
+        return -1
+
+    def shutdown(self, how):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class LoopbackServer:
+    """RequestsHandler 需要的服务器属性，不监听套接字"""
+    server_name = 'localhost'
+    server_port = 80
+    client_address = ('127.0.0.1', 50000)
+
+    def __init__(self, app, HandlerClass=RequestsHandler):
+        self.app = app
+        self.HandlerClass = HandlerClass
+        self.handler_pool = Pool(HandlerClass)
+        # 时间轮不启动，只用于 handler 设置、取消定时器
+        self.timer_wheel = TimerWheel()
+
+    def handle_connection(self, conn, client_address=None):
+        handler = self.handler_pool.acquire()
+        try:
+            handler.process(conn, client_address or self.client_address, self)
+        finally:
+            self.handler_pool.release(handler)
+
+    def connection_idle(self, idle, admit=False):
+        return True
+
+    def request(self, data):
+        """处理一段请求字节流，返回响应字节"""
+        conn = LoopbackConnection(data, keep_output=True)
+        self.handle_connection(conn)
+        return bytes(conn.output)
+
+
+class _TracingHandler(RequestsHandler):
+    __slots__ = ()
+    trace_sample_rate = 1.0
+
+
+def _run(server, streams, iterations):
+    handle = server.handle_connection
+    for i in range(iterations):
+        handle(LoopbackConnection(streams[i % len(streams)]))
+
+
+def replay(app, streams, iterations=100000, alloc_iterations=1000):
+    """重放请求字节流 iterations 次，返回统计结果
+
+    - per_request: 每个连接 (字节流) 的平均处理时间，单位秒
+    - stages: 开启追踪时各阶段的平均耗时，单位秒
+    - alloc_peak: 处理一个连接时的内存峰值，单位字节
+    - alloc_blocks: 每个连接处理完后残留的内存块数，持续大于 0 说明有泄漏
+    """
+    if isinstance(streams, bytes):
+        streams = [streams]
+    stats = {}
+    enabled, utils.log_enabled = utils.log_enabled, False
+    try:
+        # 预热，填充对象池和缓存
+        _run(LoopbackServer(app), streams, min(iterations, 1000))
+
+        gc.collect()
+        server = LoopbackServer(app)
+        start = perf_counter()
+        _run(server, streams, iterations)
+        stats['per_request'] = (perf_counter() - start) / iterations
+
+        traces = []
+
+        def traced_app(environ, start_response):
+            traces.append(environ['server.trace'])
+            return app(environ, start_response)
+
+        server = LoopbackServer(traced_app, _TracingHandler)
+        _run(server, streams, min(iterations, 10000))
+        totals = defaultdict(float)
+        for trace in traces:
+            for name, duration, _ in trace.durations():
+                totals[name] += duration
+        stats['stages'] = {name: total / len(traces)
+                           for name, total in totals.items()}
+
+        server = LoopbackServer(app)
+        tracemalloc.start()
+        try:
+            _run(server, streams, 10)
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            _run(server, streams, 1)
+            stats['alloc_peak'] = tracemalloc.get_traced_memory()[1] - current
+
+            before = tracemalloc.take_snapshot()
+            _run(server, streams, alloc_iterations)
+            after = tracemalloc.take_snapshot()
+            blocks = sum(s.count_diff for s in after.compare_to(before,
+                                                                'filename'))
+            stats['alloc_blocks'] = blocks / alloc_iterations
+        finally:
+            tracemalloc.stop()
+    finally:
+        utils.log_enabled = enabled
+    return stats
+
+
+def _load_app(spec):
+    module, _, name = spec.partition(':')
+    return getattr(importlib.import_module(module), name or 'app')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('files', nargs='+', help='录制的原始请求字节流文件')
+    parser.add_argument('-n', '--iterations', type=int, default=100000)
+    parser.add_argument('--app', default='app:app', help='module:attribute')
+    args = parser.parse_args(argv)
+
+    streams = []
+    for filename in args.files:
+        with open(filename, 'rb') as f:
+            # 兼容用 \n 换行保存的文件
+            data = f.read()
+            if b'\r\n' not in data:
+                data = data.replace(b'\n', b'\r\n')
+            streams.append(data)
+
+    stats = replay(_load_app(args.app), streams, args.iterations)
+    print(f"per request: {stats['per_request'] * 1e6:.2f} us")
+    for name, duration in stats['stages'].items():
+        print(f'  {name:<12} {duration * 1e6:.2f} us')
+    print(f"alloc peak:  {stats['alloc_peak']} B")
+    print(f"leaked blocks per request: {stats['alloc_blocks']:.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""对象池，复用每个连接都要创建的对象，减少内存分配"""
+
+from collections import deque
+
+__all__ = ['Pool', 'buffer_pool', 'BUFFER_SIZE']
+
+
+class Pool:
+    """简单的对象池
+
+    deque 的 append/pop 是线程安全的，不需要额外加锁。
+    池里最多保留 maxsize 个对象，多余的直接丢弃交给垃圾回收。
+    """
+    __slots__ = ('factory', 'reset', 'maxsize', '_items')
+
+    def __init__(self, factory, maxsize=64, reset=None):
+        """
+        :param factory: 池为空时创建新对象
+        :param reset: 对象归还时调用，清理上一次使用留下的状态
+        """
+        self.factory = factory
+        self.reset = reset
+        self.maxsize = maxsize
+        self._items = deque()
+
+    def __len__(self):
+        return len(self._items)
+
+    def acquire(self):
+        try:
+            return self._items.pop()
+        except IndexError:
+            return self.factory()
+
+    def release(self, item):
+        if self.reset is not None:
+            self.reset(item)
+        if len(self._items) < self.maxsize:
+            self._items.append(item)
+
+
+BUFFER_SIZE = 8192
+
+# 进程内共用的定长 I/O 缓冲区
+# 只通过切片赋值、readinto 写入，长度不变，bytearray 不会重新分配内存
+buffer_pool = Pool(lambda: bytearray(BUFFER_SIZE), maxsize=256)
@@ -0,0 +1,130 @@
+"""令牌桶限流中间件，按客户端地址限制请求速率"""
+
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+from server.utils import log
+
+__all__ = ['RateLimiter']
+
+
+class _Bucket:
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
+
+
+class RateLimiter:
+    """WSGI 中间件，在调用 app 之前按客户端限流::
+
+        app = RateLimiter(app, rate=10, burst=20)
+
+    每个客户端一个令牌桶，令牌以 rate 个/秒的速度补充，最多存 burst 个，
+    每个请求消耗一个令牌，没有令牌时直接返回 429。
+
+    令牌桶分散保存在 shards 个带锁的分片里，减少线程之间的锁竞争。
+    桶的总数不超过 max_buckets，超过时淘汰最久没有请求的桶。
+    """
+    body = b'Too Many Requests'
+
+    def __init__(self, app, rate, burst=None, key_header=None, shards=16,
+                 max_buckets=10000, trusted_hops=1):
+        """
+        :param rate: 每秒补充的令牌数
+        :param burst: 桶的容量，允许的突发请求数，默认等于 rate (至少为 1)
+        :param key_header: 用请求头区分客户端，如 'X-Forwarded-For',
+            只应在可信的代理之后使用。默认使用 REMOTE_ADDR
+        :param trusted_hops: key_header 是逗号分隔的地址列表时，
+            前面可信代理的层数。每层代理在末尾追加它看到的地址，
+            所以从右往左数第 trusted_hops 个才是真实的客户端，
+            更左边的值由客户端自己填写，不能用来区分客户端
+        """
+        if trusted_hops < 1:
+            raise ValueError('trusted_hops must be at least 1')
+        if rate <= 0:
+            raise ValueError('rate must be positive')
+        if burst is None:
+            burst = max(1, rate)
+        if burst < 1:
+            # 容量不到一个令牌的桶永远不能放行请求
+            raise ValueError('burst must be at least 1')
+        self.app = app
+        self.rate = rate
+        self.burst = burst
+        self.key = 'REMOTE_ADDR'
+        self.trusted_hops = trusted_hops
+        if key_header:
+            self.key = 'HTTP_' + key_header.upper().replace('-', '_')
+        self.shard_size = max(1, max_buckets // shards)
+        self._shards = [(threading.Lock(), OrderedDict())
+                        for _ in range(shards)]
+        # 空闲超过 full_time 秒的桶已经补满，和新建的桶没有区别，可以直接淘汰
+        self.full_time = self.burst / rate
+        self._retry_headers = {}
+        self._warned = False
+
+    def __call__(self, environ, start_response):
+        key = self.client_key(environ)
+        if not key:
+            # Unix 域套接字没有 REMOTE_ADDR，所有客户端会共用一个桶
+            if not self._warned:
+                self._warned = True
+                log(f'RateLimiter: {self.key} is empty, requests are not '
+                    f'rate limited')
+            return self.app(environ, start_response)
+        wait = self.acquire(key)
+        if wait:
+            start_response('429 Too Many Requests', self._headers(wait))
+            return [self.body]
+        return self.app(environ, start_response)
+
+    def client_key(self, environ):
+        value = environ.get(self.key) or ''
+        # X-Forwarded-For: <客户端填写的值>, client, proxy1
+        entries = value.rsplit(',', self.trusted_hops)
+        return entries[max(0, len(entries) - self.trusted_hops)].strip()
+
+    def acquire(self, key):
+        """消耗 key 的一个令牌，成功返回 0，否则返回需要等待的秒数"""
+        now = monotonic()
+        lock, buckets = self._shards[hash(key) % len(self._shards)]
+        with lock:
+            bucket = buckets.get(key)
+            if bucket is None:
+                self._evict(buckets, now)
+                bucket = buckets[key] = _Bucket(self.burst, now)
+            else:
+                buckets.move_to_end(key)
+                bucket.tokens = min(
+                    self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+                bucket.updated = now
+
+            if bucket.tokens >= 1:
+                bucket.tokens -= 1
+                return 0
+            return (1 - bucket.tokens) / self.rate
+
+    def _evict(self, buckets, now):
+        # 最久没有请求的桶在最前面
+        while buckets:
+            key, bucket = next(iter(buckets.items()))
+            if (len(buckets) < self.shard_size
+                    and now - bucket.updated < self.full_time):
+                break
+            del buckets[key]
+
+    def _headers(self, wait):
+        """预先编码好的 429 响应头，按 Retry-After 秒数缓存"""
+        retry_after = max(1, -int(-wait // 1))
+        headers = self._retry_headers.get(retry_after)
+        if headers is None:
+            headers = self._retry_headers[retry_after] = [
+                ('Content-Type', 'text/plain'),
+                ('Content-Length', str(len(self.body))),
+                ('Retry-After', str(retry_after)),
+            ]
+        # 服务器会修改响应头列表，返回副本
+        return list(headers)
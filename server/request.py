@@ -6,6 +6,8 @@ __all__ = ['Request']
 
 
 class Request:
+    __slots__ = ('method', 'path', 'query_string', 'version', 'header',
+                 'body', '_request_line')
     encoding = 'latin-1'
 
     def __init__(self):
@@ -18,18 +20,27 @@ class Request:
         self._request_line = None
 
     @classmethod
-    def execute(cls, sock):
-        """ :param sock:套接字对象 """
-        fp = sock.makefile('rb')
+    def execute(cls, fp, phase=None):
+        """ :param fp: 连接的读文件对象 sock.makefile('rb')
+        :param phase: 读完请求行后调用 phase('header')，用于切换超时阶段
+        :return: 请求完整读取之前客户端关闭了连接时返回 None
+        """
         self = cls()
         request_line = str(fp.readline(), cls.encoding)
+        if not request_line:
+            return None
         self._request_line = request_line.rstrip()
+        if phase is not None:
+            phase('header')
 
         lst = []
         for line in fp:
             if line == b'\r\n':
                 break
             lst.append(line)
+        else:
+            # 请求头没有读完连接就关闭了
+            return None
 
         headers = ''.join(map(lambda x: x.decode(cls.encoding), lst))
 
@@ -55,6 +66,22 @@ class Request:
             k, v = kv.split(': ', 1)
             self.header.add_header(k, v)
 
+    @property
+    def content_length(self):
+        """请求体长度，没有或不合法时返回 0"""
+        try:
+            return max(0, int(self.header.get('Content-Length', 0)))
+        except ValueError:
+            return 0
+
+    @property
+    def keep_alive(self):
+        """HTTP/1.1 默认保持连接，除非客户端要求关闭"""
+        connection = (self.header.get('Connection') or '').lower()
+        if self.version == 'HTTP/1.1':
+            return connection != 'close'
+        return False
+
     def parse_body(self, body):
         """ :param :body string
         不解析，留给 application 处理"""
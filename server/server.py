@@ -1,10 +1,16 @@
 """简单的 WEB 服务器, 符合 WSGI 接口规范"""
 
+import os
+import stat
 import socket
 import selectors
 import threading
+from functools import partial
 
-from .utils import logged
+from .utils import logged, log
+from .timer import TimerWheel
+from .handler import RequestsHandler
+from .pool import Pool
 
 # windows 系统没有 PollSelector
 if hasattr(selectors, 'PollSelector'):
@@ -13,20 +19,104 @@ else:
     _ServerSelector = selectors.SelectSelector
 
 
+def _overload_response(retry_after):
+    """预先构造好的 503 响应，过载时直接发送，不经过 application"""
+    return (
+        'HTTP/1.1 503 Service Unavailable\r\n'
+        f'Retry-After: {retry_after}\r\n'
+        'Content-Length: 0\r\n'
+        'Connection: close\r\n'
+        '\r\n'
+    ).encode('latin-1')
+
+
+def _discard_input(sock):
+    """读空非阻塞套接字里已经到达的数据，返回对端是否已关闭"""
+    try:
+        while True:
+            if not sock.recv(4096):
+                return True
+    except (BlockingIOError, InterruptedError):
+        return False
+    except OSError:
+        return True
+
+
+def _linger_close(sock):
+    _discard_input(sock)
+    sock.close()
+
+
 class BaseServer:
-    request_queue_size = 128
+    request_queue_size = 1024  # listen 队列长度
+    accept_batch = 64  # 每次唤醒最多 accept 的连接数
+    handler_pool_size = 64  # 空闲 handler 实例的最大缓存数
+    max_inflight = None  # 正在处理的请求数上限，None 表示不限制
+    retry_after = 1  # 过载时 503 响应的 Retry-After 秒数
+    reject_linger = 1  # 发送 503 后等待客户端读取响应的秒数
     timeout = None
 
-    def __init__(self, host, port, HandlerClass, *args, **kwargs):
-        self.HandlerClass = HandlerClass
-        self.server_address = (host, port)
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # 设置端口马上复用
-        # 端口被 socket 使用过，执行 socket.close() 关闭连接后，但此时端口还没有释放
-        # 需要经过一个 TIME_WAIT 过程后才能使用， setsockopt() 可设置立即使用
-        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.socket.bind(self.server_address)
+    def __init__(self, host='127.0.0.1', port=3000, HandlerClass=None,
+                 *args, backlog=None, accept_batch=None, max_inflight=None,
+                 retry_after=None, unix_socket=None, fd=None,
+                 defer_accept=None, fastopen=None, rcvbuf=None, sndbuf=None,
+                 nodelay=False, **kwargs):
+        """
+        :param unix_socket: 监听 Unix 域套接字路径，代替 (host, port)
+        :param fd: 继承的已监听套接字描述符 (systemd socket activation 从 3 开始)
+        :param defer_accept: TCP_DEFER_ACCEPT 秒数，有数据到达才唤醒 accept
+        :param fastopen: TCP_FASTOPEN 队列长度
+        :param rcvbuf, sndbuf: SO_RCVBUF / SO_SNDBUF 大小，accept 的连接会继承
+        :param nodelay: 对 accept 的 TCP 连接设置 TCP_NODELAY
+        """
+        self.HandlerClass = HandlerClass or RequestsHandler
+        # 复用 handler 实例，避免每个连接都重新分配
+        self.handler_pool = Pool(self.HandlerClass, self.handler_pool_size)
+        if backlog is not None:
+            self.request_queue_size = backlog
+        if accept_batch is not None:
+            self.accept_batch = accept_batch
+        if max_inflight is not None:
+            self.max_inflight = max_inflight
+        if retry_after is not None:
+            self.retry_after = retry_after
+        self._overload_response = _overload_response(self.retry_after)
+        # 正在处理请求的连接数，keep-alive 连接等待下一个请求时不计入
+        self._inflight = 0
+        self._inflight_lock = threading.Lock()
+        # 所有连接共用的超时时间轮
+        self.timer_wheel = TimerWheel()
+        self.unix_socket = None
+
+        if fd is not None:
+            # 继承父进程 (如 systemd) 已经 bind 好的套接字，地址族自动识别
+            self.socket = socket.socket(fileno=fd)
+        elif unix_socket is not None:
+            self.socket = self._unix_socket(unix_socket)
+            self.unix_socket = unix_socket
+        else:
+            # host 包含 ':' 视为 IPv6 地址
+            family = socket.AF_INET6 if ':' in host else socket.AF_INET
+            self.socket = socket.socket(family, socket.SOCK_STREAM)
+            # 设置端口马上复用
+            # 端口被 socket 使用过，执行 socket.close() 关闭连接后，但此时端口还没有释放
+            # 需要经过一个 TIME_WAIT 过程后才能使用， setsockopt() 可设置立即使用
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.socket.bind((host, port))
+
+        self.is_tcp = self.socket.family in (socket.AF_INET, socket.AF_INET6)
+        self.nodelay = nodelay and self.is_tcp
+        self._set_listen_options(defer_accept, fastopen, rcvbuf, sndbuf)
         self.socket.listen(self.request_queue_size)
+        # 非阻塞监听套接字，一次唤醒可以把 listen 队列里的连接全部取出
+        self.socket.setblocking(False)
+
+        if self.is_tcp:
+            self.server_address = self.socket.getsockname()[:2]
+            self.server_name, self.server_port = self.server_address
+        else:
+            self.server_address = self.socket.getsockname()
+            self.server_name, self.server_port = 'localhost', ''
 
         # Event 是线程同步对象，内部标志默认是 False
         # Event.clear() 恢复初始化，标志置为 False
@@ -35,11 +125,39 @@ class BaseServer:
         self.__is_shut_down = threading.Event()
         self.__shutdown_request = False
 
+    @staticmethod
+    def _unix_socket(path):
+        # 删除上次运行遗留的套接字文件，否则 bind 失败
+        try:
+            if stat.S_ISSOCK(os.stat(path).st_mode):
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        return sock
+
+    def _set_listen_options(self, defer_accept, fastopen, rcvbuf, sndbuf):
+        """监听套接字调优，平台不支持的选项直接忽略"""
+        sock = self.socket
+        if rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        if sndbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+        if not self.is_tcp:
+            return
+        if defer_accept and hasattr(socket, 'TCP_DEFER_ACCEPT'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_DEFER_ACCEPT,
+                            defer_accept)
+        if fastopen and hasattr(socket, 'TCP_FASTOPEN'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_FASTOPEN, fastopen)
+
     def run(self, poll_interval=0.5):
         """启动服务
         :param poll_interval 轮询间隔事件，单位秒
         """
         self.__is_shut_down.clear()
+        self.timer_wheel.start()
         try:
             with _ServerSelector() as selector:
                 # 套接字注册一个读事件
@@ -52,11 +170,70 @@ class BaseServer:
                         break
                     if ready:
                         # 套接字可读，开始接受并处理请求
-                        self.process_request(*self.socket.accept())
+                        self._accept_requests()
         finally:
+            self.timer_wheel.stop()
             self.__shutdown_request = False
             self.__is_shut_down.set()
 
+    def _accept_requests(self):
+        """批量 accept，直到队列为空 (EAGAIN) 或达到 accept_batch 上限"""
+        for _ in range(self.accept_batch):
+            try:
+                request, client_address = self.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # 文件描述符耗尽等错误，等待下次唤醒再试
+                log(f'Accept failed: {e}')
+                return
+
+            if self.nodelay:
+                request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            if self.overloaded():
+                self.reject_request(request)
+            else:
+                self.process_request(request, client_address)
+
+    def overloaded(self):
+        """正在处理的请求数超过水位线"""
+        return (self.max_inflight is not None
+                and self._inflight >= self.max_inflight)
+
+    def connection_idle(self, idle, admit=False):
+        """handler 在 keep-alive 连接等待下一个请求时调用 (idle=True)，
+        收到请求行后再调用 (idle=False)，空闲连接不触发过载保护
+
+        :param admit: 空闲连接收到新请求时和 accept 一样检查水位线，
+            过载时不计入正在处理的请求，返回 False
+        """
+        with self._inflight_lock:
+            if admit and not idle and self.overloaded():
+                return False
+            self._inflight += -1 if idle else 1
+        return True
+
+    def reject_request(self, request):
+        """过载时直接返回 503 并关闭连接，不排队等待
+
+        未读取的请求字节还在接收缓冲里时 close() 会让内核发送 RST，
+        客户端可能来不及读到 503。先关闭写方向并读空接收缓冲，
+        由时间轮在 reject_linger 秒后再读一次并关闭。
+        """
+        try:
+            request.setblocking(False)
+            request.send(self._overload_response)
+            request.shutdown(socket.SHUT_WR)
+            if _discard_input(request):
+                request.close()
+                return
+        except OSError:
+            request.close()
+            return
+        self.timer_wheel.schedule(self.reject_linger,
+                                  partial(_linger_close, request))
+
     def shutdown(self):
         """停止服务"""
         self.__shutdown_request = True
@@ -64,10 +241,29 @@ class BaseServer:
 
     def process_request(self, request, client_address):
         """  MinIn子类复写 """
-        self.HandlerClass(request, client_address, self)
+        with self._inflight_lock:
+            self._inflight += 1
+        try:
+            self.handle_connection(request, client_address)
+        finally:
+            with self._inflight_lock:
+                self._inflight -= 1
+
+    def handle_connection(self, request, client_address):
+        """从对象池取出 handler 处理连接，处理完归还"""
+        handler = self.handler_pool.acquire()
+        try:
+            handler.process(request, client_address, self)
+        finally:
+            self.handler_pool.release(handler)
 
     def server_close(self):
         self.socket.close()
+        if self.unix_socket is not None:
+            try:
+                os.unlink(self.unix_socket)
+            except OSError:
+                pass
 
     def __enter__(self):
         return self
@@ -87,11 +283,18 @@ class ThreadingMixIn:
     _threads = None
 
     def process_request_thread(self, request, client_address):
-        self.HandlerClass(request, client_address, self)
+        try:
+            self.handle_connection(request, client_address)
+        finally:
+            with self._inflight_lock:
+                self._inflight -= 1
 
     @logged('Connected')
     def process_request(self, request, client_address):
         """Start a new thread to process the request."""
+        # 在主线程里计数，避免线程还没启动时水位线判断失效
+        with self._inflight_lock:
+            self._inflight += 1
         t = threading.Thread(target=self.process_request_thread,
                              args=(request, client_address))
         t.daemon = self.daemon_threads
@@ -99,7 +302,14 @@ class ThreadingMixIn:
             if self._threads is None:
                 self._threads = []
             self._threads.append(t)
-        t.start()
+        try:
+            t.start()
+        except RuntimeError:
+            # 线程创建失败时归还计数并关闭连接
+            with self._inflight_lock:
+                self._inflight -= 1
+            request.close()
+            raise
 
     @logged('Server closed')
     def server_close(self):
@@ -116,8 +326,9 @@ class ThreadingMixIn:
 
 class WSGIServer(ThreadingMixIn, BaseServer):
     """继承 ThreadingMixIn, BaseServer"""
-    def __init__(self, host, port, HandlerClass, app, *args, **kwargs):
-        super().__init__(host, port, HandlerClass)
+    def __init__(self, host='127.0.0.1', port=3000, HandlerClass=None,
+                 app=None, *args, **kwargs):
+        super().__init__(host, port, HandlerClass, *args, **kwargs)
         self.app = app
 
 
@@ -0,0 +1,128 @@
+""" wsgi.input 输入流 """
+
+from server.pool import buffer_pool
+
+__all__ = ['InputStream', 'ClientDisconnected']
+
+
+class ClientDisconnected(ConnectionError):
+    """请求体没有读完客户端就断开了连接"""
+
+
+class InputStream:
+    """按 Content-Length 限制读取长度的 wsgi.input
+
+    直接从连接的读文件对象读取，读文件的缓冲区就是预读缓冲，
+    在同一个连接的多个请求之间复用。读到 Content-Length 后返回空字节，
+    app 不会阻塞到套接字超时。
+    """
+    __slots__ = ('_rfile', 'remaining', '_on_read', '_deadline')
+
+    def __init__(self, rfile=None, length=0):
+        self.reset(rfile, length)
+
+    def reset(self, rfile, length, on_read=None, deadline=None):
+        """:param on_read: app 第一次读取请求体之前调用一次，用于发送 100 Continue
+        :param deadline: 每次读取套接字之前调用 deadline(True)，之后调用
+            deadline(False)，截止时间只覆盖等待客户端的时间
+        """
+        self._rfile = rfile
+        self.remaining = length  # 还没有读取的请求体字节数
+        self._on_read = on_read
+        self._deadline = deadline
+
+    def _guarded(self, read, arg):
+        deadline = self._deadline
+        if deadline is None:
+            return read(arg)
+        deadline(True)
+        try:
+            return read(arg)
+        finally:
+            deadline(False)
+
+    def _limit(self, size):
+        if self._on_read is not None and self.remaining:
+            on_read, self._on_read = self._on_read, None
+            on_read()
+        if size is None or size < 0 or size > self.remaining:
+            return self.remaining
+        return size
+
+    def _consumed(self, n, wanted):
+        self.remaining -= n
+        if n < wanted:
+            self.remaining = 0
+            raise ClientDisconnected('Client disconnected before sending '
+                                     'the whole request body')
+
+    def read(self, size=-1):
+        size = self._limit(size)
+        if not size:
+            return b''
+        data = self._guarded(self._rfile.read, size)
+        self._consumed(len(data), size)
+        return data
+
+    def readline(self, size=-1):
+        size = self._limit(size)
+        if not size:
+            return b''
+        line = self._guarded(self._rfile.readline, size)
+        if not line:
+            self._consumed(0, size)
+        self.remaining -= len(line)
+        return line
+
+    def readlines(self, hint=-1):
+        lines = []
+        total = 0
+        for line in self:
+            lines.append(line)
+            total += len(line)
+            if 0 < hint <= total:
+                break
+        return lines
+
+    def readinto(self, b):
+        with memoryview(b) as view:
+            size = self._limit(view.nbytes)
+            if not size:
+                return 0
+            n = self._guarded(self._rfile.readinto, view[:size])
+        self._consumed(n, size)
+        return n
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def awaiting_continue(self):
+        """客户端还在等待 100 Continue，剩余的请求体不会发送"""
+        return self._on_read is not None and self.remaining > 0
+
+    def drain(self, limit):
+        """丢弃 app 没有读取的请求体，连接才能继续处理下一个请求
+
+        :param limit: 剩余字节超过 limit 时放弃读取，返回 False，调用方应关闭连接
+        """
+        if not self.remaining:
+            return True
+        if self.remaining > limit or self.awaiting_continue():
+            # 客户端还在等待 100 Continue 时请求体不会发送，只能关闭连接
+            return False
+
+        buffer = buffer_pool.acquire()
+        try:
+            while self.remaining:
+                self.readinto(buffer)
+        except (OSError, ValueError):
+            return False
+        finally:
+            buffer_pool.release(buffer)
+        return True
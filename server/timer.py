@@ -0,0 +1,88 @@
+"""哈希时间轮，所有连接共用一个定时器线程管理超时"""
+
+import threading
+import time
+
+from server.utils import log
+
+__all__ = ['TimerWheel']
+
+
+class _Timer:
+    __slots__ = ('callback', 'rounds', 'slot')
+
+    def __init__(self, callback, rounds, slot):
+        self.callback = callback
+        self.rounds = rounds  # 还需要转几圈才到期
+        self.slot = slot
+
+
+class TimerWheel:
+    """哈希时间轮
+
+    时间轮有 slots 个槽，每 tick 秒指针前进一格，定时器按到期的 tick 数
+    散列到对应的槽里，超过一圈的定时器记录剩余圈数。
+    添加、取消定时器都是 O(1)，每 tick 只检查当前槽。
+    """
+
+    def __init__(self, tick=0.1, slots=512):
+        self.tick = tick
+        self._slots = [set() for _ in range(slots)]
+        self._cursor = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def schedule(self, delay, callback):
+        """delay 秒后在时间轮线程里调用 callback，返回定时器用于取消"""
+        ticks = max(1, -int(-delay // self.tick))  # 向上取整
+        n = len(self._slots)
+        with self._lock:
+            slot = (self._cursor + ticks) % n
+            timer = _Timer(callback, (ticks - 1) // n, slot)
+            self._slots[slot].add(timer)
+        return timer
+
+    def cancel(self, timer):
+        with self._lock:
+            self._slots[timer.slot].discard(timer)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        next_tick = time.monotonic() + self.tick
+        while not self._stop.wait(max(0, next_tick - time.monotonic())):
+            # 线程被延迟调度时，补上落下的 tick
+            while next_tick <= time.monotonic():
+                self._advance()
+                next_tick += self.tick
+
+    def _advance(self):
+        with self._lock:
+            self._cursor = (self._cursor + 1) % len(self._slots)
+            bucket = self._slots[self._cursor]
+            expired = []
+            for timer in bucket:
+                if timer.rounds:
+                    timer.rounds -= 1
+                else:
+                    expired.append(timer)
+            bucket.difference_update(expired)
+
+        # 回调在锁外执行，回调里可以再添加定时器
+        for timer in expired:
+            try:
+                timer.callback()
+            except Exception as e:
+                log(f'Timer callback failed: {e!r}')
@@ -0,0 +1,161 @@
+"""请求追踪，记录请求处理各阶段的时间点，可以输出 Server-Timing 响应头"""
+
+import re
+import random
+from time import perf_counter
+
+__all__ = ['Trace', 'NULL_TRACE', 'should_sample', 'parse_traceparent']
+
+# W3C traceparent: version-trace_id-parent_id-flags
+_TRACEPARENT = re.compile(r'([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-'
+                          r'([0-9a-f]{2})')
+_CONTROL_CHARS = re.compile(r'[\x00-\x1f\x7f]')
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _NullTrace:
+    """未采样的请求共用的空对象，所有方法什么也不做
+
+    app 不需要判断是否采样，直接调用 environ['server.trace'] 的方法即可。
+    """
+    __slots__ = ()
+    sampled = False
+    traceparent = None
+
+    def mark(self, name):
+        pass
+
+    def add(self, name, duration, desc=None):
+        pass
+
+    def span(self, name, desc=None):
+        return _NULL_SPAN
+
+    def server_timing(self):
+        return ''
+
+
+NULL_TRACE = _NullTrace()
+
+
+class _Span:
+    __slots__ = ('trace', 'name', 'desc', 'start')
+
+    def __init__(self, trace, name, desc):
+        self.trace = trace
+        self.name = name
+        self.desc = desc
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.trace.add(self.name, perf_counter() - self.start, self.desc)
+        return False
+
+
+class Trace:
+    """一个请求的追踪记录
+
+    marks 按发生顺序保存 (阶段名, 时间点)，时间点来自单调时钟 perf_counter，
+    相邻时间点之差就是各阶段耗时。spans 保存 app 添加的 (名字, 耗时, 描述)。
+    """
+    __slots__ = ('marks', 'spans', 'traceparent')
+    sampled = True
+
+    def __init__(self, marks=(), traceparent=None):
+        self.marks = list(marks)
+        self.spans = []
+        self.traceparent = traceparent
+
+    def __repr__(self):
+        timings = ' '.join(f'{name}={duration * 1000:.3f}ms'
+                           for name, duration, _ in self.durations())
+        return f'<{type(self).__name__} {self.traceparent or "-"} {timings}>'
+
+    def mark(self, name):
+        """记录阶段 name 结束的时间点"""
+        self.marks.append((name, perf_counter()))
+
+    def add(self, name, duration, desc=None):
+        """添加一个 app 自己测量的耗时，单位秒"""
+        self.spans.append((name, duration, desc))
+
+    def span(self, name, desc=None):
+        """上下文管理器，测量 with 语句块的耗时::
+
+            with environ['server.trace'].span('db'):
+                ...
+        """
+        return _Span(self, name, desc)
+
+    def durations(self):
+        marks = self.marks
+        for (_, start), (name, end) in zip(marks, marks[1:]):
+            yield name, end - start, None
+        yield from self.spans
+
+    def server_timing(self):
+        """Server-Timing 响应头的值，耗时单位毫秒"""
+        items = []
+        for name, duration, desc in self.durations():
+            item = f'{name};dur={duration * 1000:.3f}'
+            if desc:
+                item += f';desc={_quote(desc)}'
+            items.append(item)
+        if self.traceparent:
+            items.append(f'traceparent;desc={_quote(self.traceparent)}')
+        return ', '.join(items)
+
+
+def _quote(value):
+    """转成 quoted-string，去掉控制字符，防止拆分响应头"""
+    value = _CONTROL_CHARS.sub('', str(value))
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def parse_traceparent(value):
+    """格式合法的 traceparent 原样返回，否则返回 None
+
+    只有合法的值才会用来决定是否采样、写进 Server-Timing 响应头
+    """
+    if not value:
+        return None
+    match = _TRACEPARENT.fullmatch(value)
+    if match is None:
+        return None
+    version, trace_id, parent_id, _ = match.groups()
+    if version == 'ff' or not int(trace_id, 16) or not int(parent_id, 16):
+        return None
+    return value
+
+
+def _parent_sampled(traceparent):
+    """flags 最低位表示上游已采样"""
+    traceparent = parse_traceparent(traceparent)
+    return traceparent is not None and int(traceparent[-2:], 16) & 1
+
+
+def should_sample(traceparent=None, sample_rate=0.0, follow_parent=True):
+    """按采样率决定是否追踪这个请求
+
+    :param traceparent: 请求头里的 traceparent
+    :param follow_parent: 上游已经采样的请求总是追踪
+    """
+    if sample_rate and random.random() < sample_rate:
+        return True
+    return bool(follow_parent and traceparent
+                and _parent_sampled(traceparent))
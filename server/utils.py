@@ -1,12 +1,18 @@
 import functools
+from collections.abc import Mapping
 from time import ctime, gmtime
 from os.path import dirname, abspath, join
 
 cur_dir = abspath(dirname(__name__))
 
+# 关闭后 log() 不输出，用于基准测试
+log_enabled = True
+
 
 def log(*args, **kwargs):
     """ 日志打印，同时保存至文件中 """
+    if not log_enabled:
+        return
     curr_time = ctime()
     print(curr_time, *args, **kwargs)
     with open(join(cur_dir, 'server-run.log'), 'a+') as f:
@@ -22,7 +28,7 @@ def logged(message=None):
             if m == 'Connected':
                 log(m, args[-1])
             elif m == 'Running on':
-                log(m, f"http://{kwargs.get('host')}:{kwargs.get('port')}")
+                log(m, _listen_url(kwargs))
             else:
                 log(m)
             return func(*args, **kwargs)
@@ -32,6 +38,18 @@ def logged(message=None):
     return log_wrapper
 
 
+def _listen_url(options):
+    """make_server 参数对应的监听地址，用于启动日志"""
+    if options.get('fd') is not None:
+        return f"fd://{options['fd']}"
+    if options.get('unix_socket'):
+        return f"unix:{options['unix_socket']}"
+    host = options.get('host', '127.0.0.1')
+    if ':' in host:
+        host = f'[{host}]'
+    return f"http://{host}:{options.get('port', 3000)}"
+
+
 def _to_string(value):
     if isinstance(value, bytes):
         value = value.decode("latin-1")
@@ -57,6 +75,7 @@ class Headers:
 
     Headers -> [(key-1, value-1), (key-2, value-2)...]
     """
+    __slots__ = ('_headers',)
 
     def __init__(self, headers=None):
         headers = headers if headers is not None else []
@@ -136,6 +155,191 @@ class Headers:
         del self._headers[:]
 
 
+class MultiDict(dict):
+    """一个键可以对应多个值的字典，用于查询参数和表单
+
+    MultiDict -> {key-1: [value-1, value-2], key-2: [value-3]...}
+    按键取值返回最后一个值，getlist() 返回全部值。
+    """
+    __slots__ = ()
+
+    def __init__(self, pairs=()):
+        super().__init__()
+        for k, v in pairs:
+            self.add(k, v)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({list(self.items(multi=True))})'
+
+    def __getitem__(self, key):
+        return dict.__getitem__(self, key)[-1]
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, [value])
+
+    def add(self, key, value):
+        dict.setdefault(self, key, []).append(value)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def getlist(self, key):
+        return list(dict.get(self, key, ()))
+
+    def values(self):
+        return (lst[-1] for lst in dict.values(self))
+
+    def items(self, multi=False):
+        for k, lst in dict.items(self):
+            if multi:
+                for v in lst:
+                    yield k, v
+            else:
+                yield k, lst[-1]
+
+    def update(self, other=(), **kwargs):
+        """追加而不是覆盖已有的值"""
+        if isinstance(other, MultiDict):
+            other = other.items(multi=True)
+        elif hasattr(other, 'items'):
+            other = other.items()
+        for k, v in other:
+            self.add(k, v)
+        for k, v in kwargs.items():
+            self.add(k, v)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        try:
+            return dict.pop(self, key)[-1]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+
+    def copy(self):
+        return MultiDict(self.items(multi=True))
+
+    def to_dict(self):
+        return dict(self.items())
+
+
+class ImmutableMultiDict(MultiDict):
+    """只读的 MultiDict，可以在多个请求之间共享"""
+    __slots__ = ()
+
+    def __init__(self, pairs=()):
+        add = super().add
+        for k, v in pairs:
+            add(k, v)
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError(f'{self.__class__.__name__} is immutable')
+
+    # 结果被 lru_cache 共享，dict 本身的原地修改方法也要禁止
+    __setitem__ = __delitem__ = __ior__ = add = update = _immutable
+    setdefault = pop = popitem = clear = _immutable
+
+    def __hash__(self):
+        return id(self)
+
+
+class CombinedMultiDict(Mapping):
+    """把多个 MultiDict 合并成一个只读视图，不复制数据
+
+    按键取值时后面的字典优先，和依次 update 的结果一致。
+    继承 Mapping，values()、== 等只读的 dict 接口都可以使用。
+    """
+    __slots__ = ('dicts',)
+
+    def __init__(self, dicts):
+        self.dicts = dicts
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.dicts})'
+
+    def __getitem__(self, key):
+        for d in reversed(self.dicts):
+            if key in d:
+                return d[key]
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return any(key in d for d in self.dicts)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def getlist(self, key):
+        rv = []
+        for d in self.dicts:
+            rv.extend(d.getlist(key))
+        return rv
+
+    def keys(self):
+        return dict.fromkeys(k for d in self.dicts for k in d).keys()
+
+    def values(self):
+        return (self[k] for k in self.keys())
+
+    def items(self, multi=False):
+        if multi:
+            for d in self.dicts:
+                yield from d.items(multi=True)
+        else:
+            for k in self.keys():
+                yield k, self[k]
+
+    def copy(self):
+        return MultiDict(self.items(multi=True))
+
+    def to_dict(self):
+        return dict(self.items())
+
+
+class ClosingIterator:
+    """包装 app 返回的可迭代对象，服务器调用 close() 时执行回调
+
+    用于中间件在响应发送完之后释放资源。
+    """
+    __slots__ = ('iterable', 'callbacks')
+
+    def __init__(self, iterable, *callbacks):
+        self.iterable = iterable
+        self.callbacks = callbacks
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+    def __len__(self):
+        # 服务器用 len() 判断能否自动设置 Content-Length，没有长度时抛出 TypeError
+        return len(self.iterable)
+
+    def close(self):
+        try:
+            if hasattr(self.iterable, 'close'):
+                self.iterable.close()
+        finally:
+            for callback in self.callbacks:
+                callback()
+
+
 class _Missing:
     def __repr__(self):
         return "no value"
@@ -150,21 +354,36 @@ _missing = _Missing()
 class cache_property(property):
     """缓存属性，用于类里面方法的装饰器
     描述符 __get__ 里参数 type，是类 property 里的参数
+
+    值保存在实例属性 `_cached_<name>` 上，不依赖实例的 __dict__，
+    使用 __slots__ 的类需要声明这些属性，见 :func:`cached_slots`。
     """
     def __init__(self, func, name=None, doc=None):
         self.__name__ = name or func.__name__
         self.__module__ = func.__module__
         self.__doc__ = doc or func.__doc__
         self.func = func
+        self.attr = cached_slots(self.__name__)[0]
 
     def __set__(self, obj, value):
-        obj.__dict__[self.__name__] = value
+        setattr(obj, self.attr, value)
+
+    def __delete__(self, obj):
+        try:
+            delattr(obj, self.attr)
+        except AttributeError:
+            pass
 
     def __get__(self, obj, type=None):
         if obj is None:
             return self
-        value = obj.__dict__.get(self.__name__, _missing)
+        value = getattr(obj, self.attr, _missing)
         if value is _missing:
             value = self.func(obj)
-            obj.__dict__[self.__name__] = value
+            setattr(obj, self.attr, value)
         return value
+
+
+def cached_slots(*names):
+    """cache_property 需要的 __slots__ 名字"""
+    return tuple(f'_cached_{name}' for name in names)
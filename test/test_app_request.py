@@ -0,0 +1,90 @@
+from io import BytesIO
+
+import pytest
+
+from app.request import Request
+
+
+def make_request(query_string='', body=b'', **environ):
+    env = {
+        'REQUEST_METHOD': 'GET',
+        'QUERY_STRING': query_string,
+        'HTTP_HOST': 'localhost',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': BytesIO(body),
+    }
+    env.update(environ)
+    return Request(env)
+
+
+def test_query_keeps_repeated_keys():
+    req = make_request('a=1&b=2&a=3')
+    assert req.query['a'] == '3'
+    assert req.query.getlist('a') == ['1', '3']
+    assert req.query['b'] == '2'
+
+
+def test_query_decodes_escapes_and_blank_keys():
+    req = make_request('q=hello+world%21&flag&x=a%3Db')
+    assert req.query['q'] == 'hello world!'
+    assert req.query['flag'] == ''
+    assert req.query['x'] == 'a=b'
+
+
+def test_query_is_shared_and_read_only():
+    a = make_request('k=v').query
+    b = make_request('k=v').query
+    assert a is b
+    with pytest.raises(TypeError):
+        a['k'] = 'x'
+    with pytest.raises(TypeError):
+        a |= {'evil': ['x']}
+    assert make_request('k=v').query.to_dict() == {'k': 'v'}
+
+
+def test_form_values_may_contain_equal_sign():
+    req = make_request(
+        'a=1', body=b'token=abc==&a=2',
+        REQUEST_METHOD='POST',
+        CONTENT_TYPE='application/x-www-form-urlencoded',
+    )
+    assert req.form['token'] == 'abc=='
+    assert req.params['a'] == '2'
+    assert req.params.getlist('a') == ['1', '2']
+    assert req.params['token'] == 'abc=='
+    # 和原来的 dict 一样可以使用只读的字典接口
+    assert list(req.params.values()) == ['2', 'abc==']
+    assert req.params == {'a': '2', 'token': 'abc=='}
+
+
+def test_json_decodes_body_bytes():
+    req = make_request(
+        body='{"name": "张三", "tags": [1, 2]}'.encode('utf-8'),
+        REQUEST_METHOD='POST', CONTENT_TYPE='application/json',
+    )
+    assert req.json == {'name': '张三', 'tags': [1, 2]}
+
+
+def test_json_checks_size_before_reading():
+    req = make_request(
+        body=b'[]', REQUEST_METHOD='POST', CONTENT_TYPE='application/json',
+        CONTENT_LENGTH=str(Request.MEMFILE_MAX + 1),
+    )
+    with pytest.raises(ValueError):
+        req.json
+    assert req.environ['wsgi.input'].tell() == 0
+
+
+def test_json_ignores_other_content_types():
+    req = make_request(body=b'{}', REQUEST_METHOD='POST',
+                       CONTENT_TYPE='text/plain')
+    assert req.json is None
+
+
+def test_json_uses_the_current_backend(monkeypatch):
+    from app import response
+    monkeypatch.setattr(response, 'json_loads', response.json_loads)
+    response.set_json_backend(loads=lambda data: {'custom': data})
+    req = make_request(body=b'{}', REQUEST_METHOD='POST',
+                       CONTENT_TYPE='application/json')
+    assert req.json == {'custom': b'{}'}
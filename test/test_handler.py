@@ -0,0 +1,308 @@
+import pytest
+
+from app.response import JSONResponse
+from server import utils
+from server.handler import RequestsHandler, rejection
+from server.loopback import LoopbackServer
+from server.pool import Pool, buffer_pool, BUFFER_SIZE
+from server.stream import ClientDisconnected
+
+
+@pytest.fixture(autouse=True)
+def quiet(monkeypatch):
+    monkeypatch.setattr(utils, 'log_enabled', False)
+
+
+def hello(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain'),
+                              ('Content-Length', '5')])
+    return [b'hello']
+
+
+def split_responses(data):
+    """按 Content-Length 拆分连接上的多个响应，返回 [(head, body)...]"""
+    responses = []
+    while data:
+        head, _, data = data.partition(b'\r\n\r\n')
+        length = 0
+        for line in head.split(b'\r\n')[1:]:
+            name, _, value = line.partition(b': ')
+            if name.lower() == b'content-length':
+                length = int(value)
+        responses.append((head, data[:length]))
+        data = data[length:]
+    return responses
+
+
+def test_pool_reuses_and_bounds_items():
+    resets = []
+    pool = Pool(list, maxsize=1, reset=resets.append)
+    a, b = pool.acquire(), pool.acquire()
+    pool.release(a)
+    pool.release(b)
+    assert len(pool) == 1
+    assert resets == [a, b]
+    assert pool.acquire() is a
+
+
+def test_handler_and_buffers_are_returned_to_pools():
+    server = LoopbackServer(hello)
+    buffers = len(buffer_pool)
+    server.request(b'GET / HTTP/1.1\r\nHost: a\r\nConnection: close\r\n\r\n')
+    handler = server.handler_pool.acquire()
+    server.handler_pool.release(handler)
+    assert len(buffer_pool) == max(buffers, 1)
+
+    response = server.request(b'GET / HTTP/1.0\r\nHost: a\r\n\r\n')
+    assert response.endswith(b'hello')
+    assert len(server.handler_pool) == 1
+    assert server.handler_pool.acquire() is handler
+    # 放回池里的实例不持有上一个连接的对象
+    assert handler.conn is handler.env is handler.request is None
+    assert handler.rfile is None and handler._wfile._buffer is None
+
+
+def test_blocks_larger_than_the_write_buffer():
+    block = bytes(range(256)) * (BUFFER_SIZE // 128)
+
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Length', str(3 * len(block)))])
+        return [b'', block, block[:10], block[10:], block]
+
+    server = LoopbackServer(app)
+    response = server.request(b'GET / HTTP/1.1\r\nHost: a\r\n\r\n')
+    [(head, body)] = split_responses(response)
+    assert body == block * 3
+
+
+def echo(environ, start_response):
+    body = environ['wsgi.input'].read()
+    start_response('200 OK', [('Content-Length', str(len(body)))])
+    return [body]
+
+
+def test_keep_alive_serves_pipelined_requests():
+    server = LoopbackServer(echo)
+    response = server.request(
+        b'POST /a HTTP/1.1\r\nHost: a\r\nContent-Length: 3\r\n\r\nabc'
+        b'POST /b HTTP/1.1\r\nHost: a\r\nContent-Length: 2\r\n\r\nde'
+        b'GET /c HTTP/1.1\r\nHost: a\r\nConnection: close\r\n\r\n')
+    assert [body for _, body in split_responses(response)] == [
+        b'abc', b'de', b'']
+    assert b'Connection: close' in split_responses(response)[2][0]
+
+
+def test_unread_bodies_are_drained_or_close_the_connection():
+    server = LoopbackServer(hello)
+    small = b'x' * 100
+    response = server.request(
+        b'POST / HTTP/1.1\r\nHost: a\r\nContent-Length: 100\r\n\r\n' + small +
+        b'GET / HTTP/1.1\r\nHost: a\r\n\r\n')
+    assert len(split_responses(response)) == 2
+
+    large = b'x' * (server.HandlerClass.max_drain + 1)
+    response = server.request(
+        b'POST / HTTP/1.1\r\nHost: a\r\nContent-Length: %d\r\n\r\n'
+        % len(large) + large + b'GET / HTTP/1.1\r\nHost: a\r\n\r\n')
+    assert len(split_responses(response)) == 1
+
+
+def test_input_is_bounded_by_content_length():
+    seen = []
+
+    def app(environ, start_response):
+        stream = environ['wsgi.input']
+        seen.append((stream.readline(), stream.read(), stream.read(10)))
+        return hello(environ, start_response)
+
+    server = LoopbackServer(app)
+    server.request(b'POST / HTTP/1.1\r\nHost: a\r\nContent-Length: 6\r\n\r\n'
+                   b'ab\ncdGET / HTTP/1.1\r\n\r\n')
+    assert seen[0] == (b'ab\n', b'cdG', b'')
+
+
+def test_truncated_body_raises_client_disconnected():
+    errors = []
+
+    def app(environ, start_response):
+        try:
+            environ['wsgi.input'].read()
+        except ClientDisconnected as e:
+            errors.append(e)
+        return hello(environ, start_response)
+
+    server = LoopbackServer(app)
+    server.request(b'POST / HTTP/1.1\r\nHost: a\r\nContent-Length: 10\r\n\r\n'
+                   b'abc')
+    assert len(errors) == 1
+
+
+@pytest.mark.parametrize('app_result', [[b'hello'], iter([b'hel', b'lo'])])
+def test_head_responses_have_no_body(app_result):
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return app_result if environ['REQUEST_METHOD'] == 'HEAD' else [b'hi']
+
+    server = LoopbackServer(app)
+    response = server.request(b'HEAD / HTTP/1.1\r\nHost: a\r\n\r\n'
+                              b'GET / HTTP/1.1\r\nHost: a\r\n\r\n')
+    head, _, rest = response.partition(b'\r\n\r\n')
+    assert head.startswith(b'HTTP/1.1 200 OK')
+    assert (b'Content-Length: 5' in head
+            or b'Transfer-Encoding: chunked' in head)
+    assert rest.startswith(b'HTTP/1.1 200 OK')
+
+
+@pytest.mark.parametrize('status', ['204 No Content', '304 Not Modified'])
+def test_bodiless_statuses_drop_app_data(status):
+    def app(environ, start_response):
+        if environ['PATH_INFO'] == '/empty':
+            start_response(status, [])
+            return [b'oops']
+        return hello(environ, start_response)
+
+    server = LoopbackServer(app)
+    response = server.request(b'GET /empty HTTP/1.1\r\nHost: a\r\n\r\n'
+                              b'GET / HTTP/1.1\r\nHost: a\r\n\r\n')
+    head, _, rest = response.partition(b'\r\n\r\n')
+    assert head.startswith(b'HTTP/1.1 ' + status.encode())
+    assert b'Connection: close' not in head
+    # 下一个响应紧跟在响应头之后
+    assert rest.startswith(b'HTTP/1.1 200 OK') and rest.endswith(b'hello')
+
+
+class TimingHandler(RequestsHandler):
+    __slots__ = ()
+    server_timing = True
+
+
+SAMPLED = '00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01'
+
+
+@pytest.mark.parametrize('traceparent, traced', [
+    (SAMPLED, True),
+    (SAMPLED[:-1] + '0', False),
+    ('garbage-1', False),
+    ('00-' + '0' * 32 + '-b7ad6b7169203331-01', False),
+    (SAMPLED + '"\r\nX-Injected: 1', False),
+])
+def test_only_valid_sampled_traceparents_force_tracing(traceparent, traced):
+    def app(environ, start_response):
+        with environ['server.trace'].span('db', desc='say "hi"\r\n'):
+            pass
+        return hello(environ, start_response)
+
+    server = LoopbackServer(app, TimingHandler)
+    response = server.request(
+        b'GET / HTTP/1.1\r\nHost: a\r\nConnection: close\r\n'
+        b'traceparent: ' + traceparent.encode('latin-1') + b'\r\n\r\n')
+    [(head, body)] = split_responses(response)
+    assert (b'Server-Timing: ' in head) == traced
+    assert b'X-Injected' not in head
+    if traced:
+        assert b'traceparent;desc="%s"' % SAMPLED.encode() in head
+        assert b'db;dur=' in head and b'desc="say \\"hi\\""' in head
+        for stage in (b'request;', b'parse;', b'environ;', b'app;'):
+            assert stage in head
+
+
+def decode_chunked(data):
+    body = b''
+    while True:
+        size, _, data = data.partition(b'\r\n')
+        size = int(size, 16)
+        if not size:
+            assert data == b'\r\n'
+            return body
+        body += data[:size]
+        assert data[size:size + 2] == b'\r\n'
+        data = data[size + 2:]
+
+
+def test_streamed_json_uses_chunked_encoding():
+    def app(environ, start_response):
+        rows = ({'id': i} for i in range(3))
+        return JSONResponse(rows)(environ, start_response)
+
+    server = LoopbackServer(app)
+    response = server.request(b'GET / HTTP/1.1\r\nHost: a\r\n\r\n'
+                              b'GET / HTTP/1.0\r\n\r\n')
+    first, _, second = response.partition(b'0\r\n\r\n')
+    head, _, body = (first + b'0\r\n\r\n').partition(b'\r\n\r\n')
+    assert b'Transfer-Encoding: chunked' in head
+    assert b'Connection: close' not in head
+    assert decode_chunked(body) == b'[{"id":0},{"id":1},{"id":2}]'
+    # HTTP/1.0 不支持 chunked，以关闭连接表示响应结束
+    head, _, body = second.partition(b'\r\n\r\n')
+    assert b'Transfer-Encoding' not in head and b'Connection: close' in head
+    assert body == b'[{"id":0},{"id":1},{"id":2}]'
+
+
+def test_100_continue_is_sent_when_the_app_reads_the_body():
+    server = LoopbackServer(echo)
+    response = server.request(
+        b'POST / HTTP/1.1\r\nHost: a\r\nExpect: 100-continue\r\n'
+        b'Content-Length: 3\r\n\r\nabc')
+    assert response.startswith(b'HTTP/1.1 100 Continue\r\n\r\n'
+                               b'HTTP/1.1 200 OK\r\n')
+    assert response.endswith(b'abc')
+
+
+def test_unread_expect_body_skips_100_and_closes():
+    server = LoopbackServer(hello)
+    # 客户端在收到 100 Continue 之前不发送请求体
+    response = server.request(
+        b'POST / HTTP/1.1\r\nHost: a\r\nExpect: 100-continue\r\n'
+        b'Content-Length: 3\r\n\r\n')
+    [(head, body)] = split_responses(response)
+    assert head.startswith(b'HTTP/1.1 200 OK')
+    assert b'Connection: close' in head and body == b'hello'
+
+
+class UploadHandler(RequestsHandler):
+    __slots__ = ()
+    max_body_size = 10
+    body_types = ('application/json',)
+
+    def pre_body(self, environ):
+        if 'HTTP_AUTHORIZATION' not in environ:
+            return rejection('401 Unauthorized',
+                             [('WWW-Authenticate', 'Bearer')])
+        return super().pre_body(environ)
+
+
+@pytest.mark.parametrize('headers, status', [
+    (b'Content-Type: application/json\r\n', b'401 Unauthorized'),
+    (b'Authorization: t\r\nContent-Type: application/json\r\n'
+     b'Expect: 100-continue\r\nContent-Length: 11\r\n',
+     b'413 Payload Too Large'),
+    (b'Authorization: t\r\nContent-Type: text/plain\r\n',
+     b'415 Unsupported Media Type'),
+    (b'Authorization: t\r\nContent-Type: application/json\r\n'
+     b'Expect: 200-ok\r\n', b'417 Expectation Failed'),
+    (b'Authorization: t\r\nContent-Type: application/json; charset=utf-8'
+     b'\r\n', b'200 OK'),
+])
+def test_pre_body_rejects_before_the_app_runs(headers, status):
+    calls = []
+
+    def app(environ, start_response):
+        calls.append(environ['wsgi.input'].read())
+        return hello(environ, start_response)
+
+    server = LoopbackServer(app, UploadHandler)
+    if b'Content-Length' not in headers:
+        headers += b'Content-Length: 2\r\n'
+    response = server.request(
+        b'POST / HTTP/1.1\r\nHost: a\r\nConnection: close\r\n' + headers +
+        b'\r\n{}')
+    [(head, body)] = split_responses(response)
+    assert head.startswith(b'HTTP/1.1 ' + status)
+    if status == b'200 OK':
+        assert calls == [b'{}']
+    else:
+        # 请求体没有被读取，也没有发送 100 Continue
+        assert calls == [] and body == status
+        assert b'100 Continue' not in response
+    if status.startswith(b'401'):
+        assert b'WWW-Authenticate: Bearer' in head
@@ -0,0 +1,146 @@
+import pytest
+
+from server.hpack import (Encoder, Decoder, HPACKError, encode_integer,
+                          decode_integer, huffman_encode, huffman_decode)
+
+
+# RFC 7541 附录 C 的示例，每组按顺序在同一个连接上编解码
+
+REQUEST = [
+    [(':method', 'GET'), (':scheme', 'http'), (':path', '/'),
+     (':authority', 'www.example.com')],
+    [(':method', 'GET'), (':scheme', 'http'), (':path', '/'),
+     (':authority', 'www.example.com'), ('cache-control', 'no-cache')],
+    [(':method', 'GET'), (':scheme', 'https'), (':path', '/index.html'),
+     (':authority', 'www.example.com'), ('custom-key', 'custom-value')],
+]
+REQUEST_TABLES = [
+    ([(':authority', 'www.example.com')], 57),
+    ([('cache-control', 'no-cache'), (':authority', 'www.example.com')], 110),
+    ([('custom-key', 'custom-value'), ('cache-control', 'no-cache'),
+      (':authority', 'www.example.com')], 164),
+]
+
+# C.3 不使用 Huffman 编码
+C3 = [
+    '8286 8441 0f77 7777 2e65 7861 6d70 6c65 2e63 6f6d',
+    '8286 84be 5808 6e6f 2d63 6163 6865',
+    '8287 85bf 400a 6375 7374 6f6d 2d6b 6579 0c63 7573 746f 6d2d 7661 6c75'
+    '65',
+]
+# C.4 使用 Huffman 编码
+C4 = [
+    '8286 8441 8cf1 e3c2 e5f2 3a6b a0ab 90f4 ff',
+    '8286 84be 5886 a8eb 1064 9cbf',
+    '8287 85bf 4088 25a8 49e9 5ba9 7d7f 8925 a849 e95b b8e8 b4bf',
+]
+
+DATE1 = 'Mon, 21 Oct 2013 20:13:21 GMT'
+DATE2 = 'Mon, 21 Oct 2013 20:13:22 GMT'
+LOCATION = 'https://www.example.com'
+COOKIE = 'foo=ASDJKHQKBZXOQWEOPIUAXQWEOIU; max-age=3600; version=1'
+RESPONSE = [
+    [(':status', '302'), ('cache-control', 'private'), ('date', DATE1),
+     ('location', LOCATION)],
+    [(':status', '307'), ('cache-control', 'private'), ('date', DATE1),
+     ('location', LOCATION)],
+    [(':status', '200'), ('cache-control', 'private'), ('date', DATE2),
+     ('location', LOCATION), ('content-encoding', 'gzip'),
+     ('set-cookie', COOKIE)],
+]
+# 动态表上限 256 字节，后面的响应会淘汰旧的表项
+RESPONSE_TABLES = [
+    ([('location', LOCATION), ('date', DATE1), ('cache-control', 'private'),
+      (':status', '302')], 222),
+    ([(':status', '307'), ('location', LOCATION), ('date', DATE1),
+      ('cache-control', 'private')], 222),
+    ([('set-cookie', COOKIE), ('content-encoding', 'gzip'), ('date', DATE2)],
+     215),
+]
+
+# C.5 不使用 Huffman 编码
+C5 = [
+    '4803 3330 3258 0770 7269 7661 7465 611d 4d6f 6e2c 2032 3120 4f63 7420'
+    '3230 3133 2032 303a 3133 3a32 3120 474d 546e 1768 7474 7073 3a2f 2f77'
+    '7777 2e65 7861 6d70 6c65 2e63 6f6d',
+    '4803 3330 37c1 c0bf',
+    '88c1 611d 4d6f 6e2c 2032 3120 4f63 7420 3230 3133 2032 303a 3133 3a32'
+    '3220 474d 54c0 5a04 677a 6970 7738 666f 6f3d 4153 444a 4b48 514b 425a'
+    '584f 5157 454f 5049 5541 5851 5745 4f49 553b 206d 6178 2d61 6765 3d33'
+    '3630 303b 2076 6572 7369 6f6e 3d31',
+]
+# C.6 使用 Huffman 编码
+C6 = [
+    '4882 6402 5885 aec3 771a 4b61 96d0 7abe 9410 54d4 44a8 2005 9504 0b81'
+    '66e0 82a6 2d1b ff6e 919d 29ad 1718 63c7 8f0b 97c8 e9ae 82ae 43d3',
+    '4883 640e ffc1 c0bf',
+    '88c1 6196 d07a be94 1054 d444 a820 0595 040b 8166 e084 a62d 1bff c05a'
+    '839b d9ab 77ad 94e7 821d d7f2 e6c7 b335 dfdf cd5b 3960 d5af 2708 7f36'
+    '72c1 ab27 0fb5 291f 9587 3160 65c0 03ed 4ee5 b106 3d50 07',
+]
+
+
+@pytest.mark.parametrize('value, prefix, encoded', [
+    (10, 5, '0a'),  # C.1.1
+    (1337, 5, '1f9a0a'),  # C.1.2
+    (42, 8, '2a'),  # C.1.3
+])
+def test_integer_representation(value, prefix, encoded):
+    assert encode_integer(value, prefix) == bytes.fromhex(encoded)
+    assert decode_integer(bytes.fromhex(encoded), 0, prefix) == (
+        value, len(encoded) // 2)
+
+
+@pytest.mark.parametrize('blocks, headers, tables, table_size', [
+    (C3, REQUEST, REQUEST_TABLES, 4096),
+    (C4, REQUEST, REQUEST_TABLES, 4096),
+    (C5, RESPONSE, RESPONSE_TABLES, 256),
+    (C6, RESPONSE, RESPONSE_TABLES, 256),
+], ids=['C.3', 'C.4', 'C.5', 'C.6'])
+def test_decoder_matches_rfc_examples(blocks, headers, tables, table_size):
+    decoder = Decoder(table_size)
+    for block, expected, (entries, size) in zip(blocks, headers, tables):
+        assert decoder.decode(bytes.fromhex(block)) == expected
+        assert list(decoder.table.entries) == entries
+        assert decoder.table.size == size
+
+
+def test_encoder_reproduces_huffman_request_examples():
+    encoder = Encoder()
+    for headers, block in zip(REQUEST, C4):
+        assert encoder.encode(headers) == bytes.fromhex(block)
+
+
+def test_encoder_round_trip_with_eviction_and_resize():
+    encoder, decoder = Encoder(), Decoder()
+    encoder.resize(256)
+    for headers in RESPONSE * 2:
+        assert decoder.decode(encoder.encode(headers)) == headers
+    # 动态表大小更新和编码结果一起发送，两端的表保持一致
+    assert decoder.table.max_size == 256
+    assert list(decoder.table.entries) == list(encoder.table.entries)
+    # set-cookie 永不索引
+    assert all(name != 'set-cookie' for name, _ in encoder.table.entries)
+
+
+def test_huffman_round_trip_and_invalid_padding():
+    data = bytes(range(256))
+    assert huffman_decode(huffman_encode(data)) == data
+    assert huffman_encode(b'www.example.com') == bytes.fromhex(
+        'f1e3c2e5f23a6ba0ab90f4ff')
+    # 填充必须是 EOS 编码的前缀 (全 1)，且不超过 7 位
+    with pytest.raises(HPACKError):
+        huffman_decode(b'\xf1\xe3\xc2\xe5\xf2\x3a\x6b\xa0\xab\x90\xf4\xfe')
+    with pytest.raises(HPACKError):
+        huffman_decode(huffman_encode(b'a') + b'\xff')
+
+
+@pytest.mark.parametrize('block', [
+    '80',  # 索引 0
+    'be',  # 动态表里没有的索引
+    '3fe21f',  # 超过 SETTINGS_HEADER_TABLE_SIZE 的大小更新
+    '410f7777',  # 字符串被截断
+])
+def test_invalid_blocks_raise(block):
+    with pytest.raises(HPACKError):
+        Decoder().decode(bytes.fromhex(block))
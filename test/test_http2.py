@@ -0,0 +1,279 @@
+import socket
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+import pytest
+
+from server import utils
+from server.hpack import Encoder, Decoder
+from server.http2 import (H2CHandler, H2Connection, frame, DATA, HEADERS,
+                          RST_STREAM, SETTINGS, GOAWAY, WINDOW_UPDATE,
+                          CONTINUATION, FLAG_END_STREAM, FLAG_END_HEADERS,
+                          FLAG_ACK, CANCEL, ENHANCE_YOUR_CALM)
+from server.server import WSGIServer
+
+PREFACE = b'PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n'
+
+
+@pytest.fixture(autouse=True)
+def quiet(monkeypatch):
+    monkeypatch.setattr(utils, 'log_enabled', False)
+
+
+@contextmanager
+def serve(app, HandlerClass=H2CHandler):
+    server = WSGIServer(port=0, app=app, HandlerClass=HandlerClass)
+    thread = threading.Thread(target=server.run, kwargs={'poll_interval': 0.05},
+                              daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class Client:
+    """只实现测试需要的帧的 h2c 客户端"""
+
+    def __init__(self, server):
+        self.sock = socket.create_connection(server.server_address, timeout=5)
+        self.encoder = Encoder()
+        self.decoder = Decoder()
+        self._buffer = b''
+        self.window = 65535  # 连接级发送窗口
+        self.windows = {}  # 流的发送窗口
+        self.sock.sendall(PREFACE + frame(SETTINGS, 0, 0))
+
+    def headers(self, stream_id, method='GET', path='/', end_stream=True):
+        self.windows[stream_id] = 65535
+        block = self.encoder.encode([
+            (':method', method), (':scheme', 'http'), (':path', path),
+            (':authority', 'a')])
+        flags = FLAG_END_HEADERS | (FLAG_END_STREAM if end_stream else 0)
+        self.sock.sendall(frame(HEADERS, flags, stream_id, block))
+
+    def body(self, stream_id, data):
+        """按发送窗口分帧发送请求体，窗口不够时等待 WINDOW_UPDATE"""
+        while data:
+            n = min(len(data), 16384, self.window, self.windows[stream_id])
+            if n <= 0:
+                self.handle(self.read_frame())
+                continue
+            chunk, data = data[:n], data[n:]
+            self.window -= n
+            self.windows[stream_id] -= n
+            self.sock.sendall(frame(DATA, 0 if data else FLAG_END_STREAM,
+                                    stream_id, chunk))
+
+    def read_frame(self):
+        while True:
+            if len(self._buffer) >= 9:
+                length = int.from_bytes(self._buffer[:3], 'big')
+                if len(self._buffer) >= 9 + length:
+                    type_, flags, stream_id = struct.unpack_from(
+                        '>BBL', self._buffer, 3)
+                    payload = self._buffer[9:9 + length]
+                    self._buffer = self._buffer[9 + length:]
+                    return type_, flags, stream_id, payload
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                return None
+            self._buffer += chunk
+
+    def handle(self, received):
+        type_, flags, stream_id, payload = received
+        if type_ == WINDOW_UPDATE:
+            increment = struct.unpack('>L', payload)[0]
+            if stream_id:
+                self.windows[stream_id] = (self.windows.get(stream_id, 0)
+                                           + increment)
+            else:
+                self.window += increment
+        elif type_ == SETTINGS and not flags & FLAG_ACK:
+            self.sock.sendall(frame(SETTINGS, FLAG_ACK, 0))
+
+    def responses(self, count):
+        """读取 count 个流的结果，{流: (头部, 响应体)}，被重置的流是 {流: 错误码}"""
+        results = {}
+        partial = {}
+        while len(results) < count:
+            received = self.read_frame()
+            assert received is not None, 'connection closed'
+            type_, flags, stream_id, payload = received
+            if type_ == HEADERS:
+                partial[stream_id] = (dict(self.decoder.decode(payload)), b'')
+            elif type_ == DATA:
+                headers, body = partial[stream_id]
+                partial[stream_id] = headers, body + payload
+                if payload:
+                    # 立即归还窗口，服务器可以继续发送
+                    self.sock.sendall(
+                        frame(WINDOW_UPDATE, 0, 0, struct.pack('>L', len(payload)))
+                        + frame(WINDOW_UPDATE, 0, stream_id,
+                                struct.pack('>L', len(payload))))
+            elif type_ == RST_STREAM:
+                results[stream_id] = struct.unpack('>L', payload)[0]
+                continue
+            else:
+                self.handle(received)
+                continue
+            if flags & FLAG_END_STREAM:
+                results[stream_id] = partial.pop(stream_id)
+        return results
+
+    def goaway(self):
+        """读到 GOAWAY 和连接关闭，返回错误码"""
+        code = None
+        while True:
+            received = self.read_frame()
+            if received is None:
+                return code
+            if received[0] == GOAWAY:
+                code = struct.unpack('>LL', received[3])[1]
+
+    def close(self):
+        self.sock.close()
+
+
+def app(environ, start_response):
+    path = environ['PATH_INFO']
+    if path == '/slow':
+        time.sleep(0.3)
+    if path == '/echo':
+        body = environ['wsgi.input'].read()
+    else:
+        body = ('%s %s %s' % (environ['REQUEST_METHOD'], path,
+                              environ['SERVER_PROTOCOL'])).encode()
+    start_response('200 OK', [('Content-Type', 'text/plain'),
+                              ('Content-Length', str(len(body))),
+                              ('Connection', 'keep-alive')])
+    return [body]
+
+
+def test_get_and_head_round_trip():
+    with serve(app) as server:
+        client = Client(server)
+        client.headers(1, path='/hello')
+        client.headers(3, method='HEAD', path='/hello')
+        results = client.responses(2)
+        headers, body = results[1]
+        assert headers[':status'] == '200'
+        assert headers['content-length'] == '19'
+        assert 'connection' not in headers and 'date' in headers
+        assert body == b'GET /hello HTTP/2.0'
+        # HEAD 只有 HEADERS 帧
+        headers, body = results[3]
+        assert headers['content-length'] == '20' and body == b''
+        client.close()
+
+        # 同一个端口上的 HTTP/1.1 请求照常处理
+        sock = socket.create_connection(server.server_address, timeout=5)
+        sock.sendall(b'GET / HTTP/1.1\r\nHost: a\r\nConnection: close\r\n\r\n')
+        assert sock.recv(4096).startswith(b'HTTP/1.1 200 OK')
+        sock.close()
+
+
+def test_streams_run_concurrently():
+    with serve(app) as server:
+        client = Client(server)
+        start = time.monotonic()
+        for stream_id in (1, 3, 5, 7):
+            client.headers(stream_id, path='/slow')
+        results = client.responses(4)
+        assert time.monotonic() - start < 1
+        assert all(body == b'GET /slow HTTP/2.0' for _, body in results.values())
+        client.close()
+
+
+def test_request_body_larger_than_the_window():
+    data = bytes(range(256)) * 800
+    with serve(app) as server:
+        client = Client(server)
+        client.headers(1, method='POST', path='/echo', end_stream=False)
+        client.body(1, data)
+        headers, body = client.responses(1)[1]
+        assert headers['content-length'] == str(len(data))
+        assert body == data
+        client.close()
+
+
+def test_continuation_flood_is_a_connection_error():
+    with serve(app) as server:
+        client = Client(server)
+        block = client.encoder.encode([(':method', 'GET')])
+        client.sock.sendall(frame(HEADERS, 0, 1, block))
+        try:
+            for _ in range(H2Connection.max_header_block // 16384 + 2):
+                client.sock.sendall(frame(CONTINUATION, 0, 1, b'\0' * 16384))
+        except OSError:
+            # 服务器发送 GOAWAY 后关闭了连接
+            pass
+        assert client.goaway() == ENHANCE_YOUR_CALM
+        client.close()
+
+
+class StalledConnection(H2Connection):
+    max_stream_workers = 2
+    idle_timeout = 1
+    poll_interval = 0.1
+
+
+class ShortTimeouts(H2CHandler):
+    __slots__ = ()
+    body_timeout = 0.2
+    connection_class = StalledConnection
+
+
+def test_stalled_request_bodies_are_reset_and_workers_capped():
+    active = []
+    peak = []
+    lock = threading.Lock()
+
+    def reader(environ, start_response):
+        if environ['PATH_INFO'] != '/read':
+            return app(environ, start_response)
+        with lock:
+            active.append(1)
+            peak.append(len(active))
+        try:
+            environ['wsgi.input'].read()
+        finally:
+            with lock:
+                active.pop()
+        return app(environ, start_response)
+
+    with serve(reader, ShortTimeouts) as server:
+        client = Client(server)
+        for stream_id in (1, 3, 5):
+            client.headers(stream_id, method='POST', path='/read',
+                           end_stream=False)
+
+        # 停滞的连接最多占用两个工作线程，其他连接不受影响
+        other = Client(server)
+        other.headers(1)
+        assert other.responses(1)[1][1] == b'GET / HTTP/2.0'
+        other.close()
+
+        start = time.monotonic()
+        assert client.responses(3) == {1: CANCEL, 3: CANCEL, 5: CANCEL}
+        assert time.monotonic() - start < 2
+        assert max(peak) == 2
+        # 没有活动的流之后，连接空闲超时关闭
+        assert client.goaway() == 0
+        client.close()
+
+
+def test_open_streams_do_not_keep_an_idle_connection_alive():
+    with serve(app, ShortTimeouts) as server:
+        client = Client(server)
+        # 打开流但不发送请求体，app 不读取请求体直接响应
+        client.headers(1, end_stream=False)
+        headers, body = client.responses(1)[1]
+        assert body == b'GET / HTTP/2.0'
+        start = time.monotonic()
+        assert client.goaway() == 0
+        assert time.monotonic() - start < 2
+        client.close()
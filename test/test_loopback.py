@@ -0,0 +1,49 @@
+import pytest
+
+from server import utils
+from server.loopback import LoopbackConnection, LoopbackServer, replay, main
+
+
+REQUESTS = (b'GET /a HTTP/1.1\r\nHost: a\r\n\r\n'
+            b'POST /b HTTP/1.1\r\nHost: a\r\nContent-Length: 2\r\n\r\nhi')
+
+
+@pytest.fixture(autouse=True)
+def quiet(monkeypatch):
+    monkeypatch.setattr(utils, 'log_enabled', False)
+
+
+def hello(environ, start_response):
+    environ['wsgi.input'].read()
+    start_response('200 OK', [('Content-Length', '5')])
+    return [b'hello']
+
+
+def test_connection_counts_and_keeps_output():
+    server = LoopbackServer(hello)
+    conn = LoopbackConnection(REQUESTS)
+    server.handle_connection(conn)
+    assert conn.closed and conn.sent > 0 and conn.output == b''
+
+    assert server.request(REQUESTS).count(b'HTTP/1.1 200 OK') == 2
+
+
+def test_replay_reports_stats_and_restores_logging(monkeypatch):
+    monkeypatch.setattr(utils, 'log_enabled', 'previous')
+    stats = replay(hello, REQUESTS, iterations=50, alloc_iterations=500)
+    assert utils.log_enabled == 'previous'
+    assert stats['per_request'] > 0
+    assert {'request', 'parse', 'environ', 'app', 'write'} <= set(
+        stats['stages'])
+    assert stats['alloc_peak'] > 0
+    # 固定的缓存开销被分摊，每个连接没有残留的内存块
+    assert stats['alloc_blocks'] < 0.5
+
+
+def test_cli_replays_recorded_files(tmp_path, capsys):
+    recorded = tmp_path / 'requests.http'
+    # 用 \n 换行保存的文件也可以重放
+    recorded.write_bytes(REQUESTS.replace(b'\r\n', b'\n'))
+    main([str(recorded), '-n', '20', '--app', 'app:app'])
+    out = capsys.readouterr().out
+    assert 'per request:' in out and 'leaked blocks' in out
@@ -0,0 +1,279 @@
+import threading
+import time
+from time import monotonic
+
+import pytest
+
+from server import utils
+from server import ratelimit
+from server.bulkhead import Bulkhead, Bulkheads
+from server.etag import ETagMiddleware
+from server.loopback import LoopbackServer
+from server.ratelimit import RateLimiter
+
+
+@pytest.fixture(autouse=True)
+def quiet(monkeypatch):
+    monkeypatch.setattr(utils, 'log_enabled', False)
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def hello(environ, start_response):
+    start_response('200 OK', [('Content-Length', '5')])
+    return [b'hello']
+
+
+def call(app, **environ):
+    """调用 WSGI app，返回 (status, headers, body)"""
+    captured = []
+
+    def start_response(status, headers, exc_info=None):
+        captured[:] = [status, headers]
+        return lambda data: None
+
+    environ.setdefault('REQUEST_METHOD', 'GET')
+    environ.setdefault('PATH_INFO', '/')
+    result = app(environ, start_response)
+    try:
+        body = b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return captured[0], dict(captured[1]), body
+
+
+def test_rate_limiter_rejects_after_burst_and_refills(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit, 'monotonic', clock)
+    app = RateLimiter(hello, rate=2, burst=3)
+
+    statuses = [call(app, REMOTE_ADDR='10.0.0.1')[0] for _ in range(4)]
+    assert statuses == ['200 OK'] * 3 + ['429 Too Many Requests']
+    status, headers, _ = call(app, REMOTE_ADDR='10.0.0.1')
+    assert headers['Retry-After'] == '1'
+    # 其他客户端不受影响
+    assert call(app, REMOTE_ADDR='10.0.0.2')[0] == '200 OK'
+
+    clock.now += 0.5
+    assert call(app, REMOTE_ADDR='10.0.0.1')[0] == '200 OK'
+    assert call(app, REMOTE_ADDR='10.0.0.1')[0].startswith('429')
+
+
+def test_rate_below_one_still_admits_requests(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit, 'monotonic', clock)
+    app = RateLimiter(hello, rate=0.5)
+    assert app.acquire('k') == 0
+    assert app.acquire('k') == pytest.approx(2.0)
+    clock.now += 2
+    assert app.acquire('k') == 0
+
+    with pytest.raises(ValueError):
+        RateLimiter(hello, rate=1, burst=0.5)
+
+
+def test_rate_limiter_skips_requests_without_a_key():
+    app = RateLimiter(hello, rate=1, burst=1)
+    for _ in range(3):
+        assert call(app, REMOTE_ADDR='')[0] == '200 OK'
+    assert not any(app._shards[i][1] for i in range(len(app._shards)))
+
+
+def test_rate_limiter_uses_forwarded_header_and_remote_addr():
+    app = RateLimiter(hello, rate=1, burst=1, key_header='X-Forwarded-For')
+    assert call(app, HTTP_X_FORWARDED_FOR='1.1.1.1, 10.0.0.1')[0] == '200 OK'
+    # 代理追加的最右一项才是真实地址，客户端伪造的前缀不会换到新的桶
+    for spoofed in ('2.2.2.2, 10.0.0.1', '10.0.0.1', 'x, y, 10.0.0.1'):
+        assert call(app, HTTP_X_FORWARDED_FOR=spoofed)[0].startswith('429')
+    assert call(app, HTTP_X_FORWARDED_FOR='10.0.0.2')[0] == '200 OK'
+
+    # 两层可信代理时取从右数第二项
+    app = RateLimiter(hello, rate=1, burst=1, key_header='X-Forwarded-For',
+                      trusted_hops=2)
+    assert call(app, HTTP_X_FORWARDED_FOR='6.6.6.6, 1.1.1.1, 10.0.0.1')[0] \
+        == '200 OK'
+    assert call(app, HTTP_X_FORWARDED_FOR='7.7.7.7, 1.1.1.1, 10.0.0.9')[0] \
+        .startswith('429')
+    assert app.client_key({'HTTP_X_FORWARDED_FOR': '1.1.1.1'}) == '1.1.1.1'
+
+    seen = []
+
+    def remote(environ, start_response):
+        seen.append((environ['REMOTE_ADDR'], environ['REMOTE_PORT']))
+        return hello(environ, start_response)
+
+    server = LoopbackServer(RateLimiter(remote, rate=1, burst=1))
+    response = server.request(b'GET / HTTP/1.1\r\nHost: a\r\n\r\n'
+                              b'GET / HTTP/1.1\r\nHost: a\r\n\r\n')
+    assert seen == [('127.0.0.1', '50000')]
+    assert response.count(b'HTTP/1.1 429 Too Many Requests') == 1
+
+
+def test_bulkhead_limits_and_queues():
+    bulkhead = Bulkhead('db', limit=1, queue_size=1, max_wait=0.05)
+    assert bulkhead.acquire()
+    # 排队等待超时
+    assert not bulkhead.acquire()
+
+    results = []
+    bulkhead.max_wait = 5
+    waiter = threading.Thread(
+        target=lambda: results.append(bulkhead.acquire()))
+    waiter.start()
+    while not bulkhead.waiting:
+        time.sleep(0.01)
+    # 队列已满，直接拒绝
+    assert not bulkhead.acquire()
+    bulkhead.release()
+    waiter.join()
+    assert results == [True] and bulkhead.active == 1
+
+
+def test_bulkheads_route_by_longest_prefix_and_release_on_close():
+    report = Bulkhead('report', limit=1)
+    api = Bulkhead('api', limit=1)
+    app = Bulkheads(hello, {'/report': report, '/report/daily': api})
+
+    result = app({'PATH_INFO': '/report/daily/x'}, lambda *args: None)
+    assert api.active == 1 and report.active == 0
+    status, headers, _ = call(app, PATH_INFO='/report/daily')
+    assert status == '503 Service Unavailable'
+    assert headers['Retry-After'] == '1'
+    result.close()
+    assert api.active == 0
+    assert call(app, PATH_INFO='/report/daily')[0] == '200 OK'
+    assert call(app, PATH_INFO='/other')[0] == '200 OK'
+
+
+def test_deadline_counts_from_request_start():
+    seen = []
+
+    def app(environ, start_response):
+        seen.append(environ['server.deadline'])
+        return hello(environ, start_response)
+
+    bulkheads = Bulkheads(app, default_timeout=5)
+    # 请求在 2 秒前开始到达，app 执行前已经用掉了 2 秒
+    started = monotonic() - 2
+    status, _, _ = call(bulkheads, **{'server.started': started,
+                                      'HTTP_X_REQUEST_TIMEOUT': '3'})
+    assert status == '200 OK' and seen == [started + 3]
+
+    status, _, _ = call(bulkheads, **{'server.started': started,
+                                      'HTTP_X_REQUEST_TIMEOUT': '1.5'})
+    assert status == '504 Gateway Timeout' and len(seen) == 1
+
+
+@pytest.mark.parametrize('value, default, timeout', [
+    ('2', 5, 2),
+    ('1e9', 5, 5),  # 只能缩短默认的截止时间
+    ('nan', 5, 5),
+    ('inf', 5, 5),
+    ('x', 5, 5),
+    ('1e9', None, 1e9),
+    ('nan', None, None),
+    ('inf', None, None),
+])
+def test_deadline_header_is_finite_and_capped(value, default, timeout):
+    bulkheads = Bulkheads(hello, default_timeout=default)
+    deadline = bulkheads.request_deadline(
+        {'server.started': 100.0, 'HTTP_X_REQUEST_TIMEOUT': value})
+    assert deadline == (None if timeout is None else 100.0 + timeout)
+
+
+def test_handler_records_request_start():
+    seen = []
+
+    def app(environ, start_response):
+        seen.append(environ['server.started'])
+        return hello(environ, start_response)
+
+    before = monotonic()
+    LoopbackServer(app).request(b'GET / HTTP/1.1\r\nHost: a\r\n\r\n'
+                                b'GET / HTTP/1.1\r\nHost: a\r\n\r\n')
+    assert before <= seen[0] <= seen[1] <= monotonic()
+
+
+def counting_app(body, headers=()):
+    calls = []
+
+    def app(environ, start_response):
+        calls.append(environ['PATH_INFO'])
+        start_response('200 OK', [('Content-Type', 'text/plain'),
+                                  *headers])
+        return [body]
+
+    return app, calls
+
+
+def test_etag_304_has_no_body_or_content_length_and_keeps_connection():
+    app, _ = counting_app(b'hello')
+    server = LoopbackServer(ETagMiddleware(app))
+    first = server.request(b'GET / HTTP/1.1\r\nHost: a\r\n\r\n')
+    etag = [line.split(b': ', 1)[1] for line in first.split(b'\r\n')
+            if line.startswith(b'ETag: ')][0]
+
+    response = server.request(
+        b'GET / HTTP/1.1\r\nHost: a\r\nIf-None-Match: ' + etag + b'\r\n\r\n'
+        b'GET / HTTP/1.1\r\nHost: a\r\nConnection: close\r\n\r\n')
+    not_modified, _, rest = response.partition(b'\r\n\r\n')
+    assert not_modified.startswith(b'HTTP/1.1 304 Not Modified')
+    assert b'Content-Length' not in not_modified
+    assert b'Connection: close' not in not_modified
+    assert b'ETag: ' + etag in not_modified
+    assert rest.startswith(b'HTTP/1.1 200 OK') and rest.endswith(b'hello')
+
+
+@pytest.mark.parametrize('app_etag', [None, '"v1"'])
+def test_version_key_skips_the_app(app_etag):
+    headers = [('ETag', app_etag)] if app_etag else []
+    app, calls = counting_app(b'hello', headers)
+    middleware = ETagMiddleware(app, version_key=lambda environ: 'v1')
+    _, first, body = call(middleware)
+    assert body == b'hello' and len(calls) == 1
+
+    status, headers, body = call(middleware, HTTP_IF_NONE_MATCH=first['ETag'])
+    assert status == '304 Not Modified' and body == b''
+    assert headers == {'ETag': first['ETag']}
+    assert len(calls) == 1
+
+
+@pytest.mark.parametrize('version_key', [None, lambda environ: 'v1'])
+def test_head_never_gets_an_empty_body_etag(version_key):
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [] if environ['REQUEST_METHOD'] == 'HEAD' else [b'hello world']
+
+    server = LoopbackServer(ETagMiddleware(app, version_key=version_key))
+    get = server.request(b'GET / HTTP/1.1\r\nHost: a\r\n\r\n')
+    head = server.request(b'HEAD / HTTP/1.1\r\nHost: a\r\n\r\n')
+    etag = [line for line in get.split(b'\r\n') if line.startswith(b'ETag')]
+    assert b'Content-Length: 11' in get and etag
+    assert b'Content-Length' not in head
+    if version_key is None:
+        assert b'ETag' not in head
+    else:
+        # 使用 GET 缓存的 ETag
+        assert etag[0] in head.split(b'\r\n')
+
+
+def test_large_bodies_are_streamed_and_cached():
+    block = b'x' * 1024
+
+    def app(environ, start_response):
+        start_response('200 OK', [])
+        return iter([block] * 8)
+
+    middleware = ETagMiddleware(app, buffer_size=2048,
+                                version_key=lambda environ: 'v')
+    status, headers, body = call(middleware)
+    assert 'ETag' not in headers and body == block * 8
+    etag = middleware._cached('v')
+    assert call(middleware, HTTP_IF_NONE_MATCH=etag)[0] == '304 Not Modified'
@@ -0,0 +1,278 @@
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+import pytest
+
+from server import utils
+from server.handler import RequestsHandler
+from server.server import WSGIServer
+
+
+@pytest.fixture(autouse=True)
+def quiet(monkeypatch):
+    monkeypatch.setattr(utils, 'log_enabled', False)
+
+
+@contextmanager
+def serve(app, **options):
+    options.setdefault('port', 0)
+    server = WSGIServer(app=app, **options)
+    thread = threading.Thread(target=server.run, kwargs={'poll_interval': 0.05},
+                              daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def hello(environ, start_response):
+    start_response('200 OK', [('Content-Length', '5')])
+    return [b'hello']
+
+
+def wait_for(predicate, timeout=2):
+    end = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < end, 'condition not reached'
+        time.sleep(0.01)
+
+
+def read_response(sock):
+    """读取一个带 Content-Length 的响应"""
+    data = b''
+    while b'\r\n\r\n' not in data:
+        chunk = sock.recv(4096)
+        if not chunk:
+            return data
+        data += chunk
+    head, _, body = data.partition(b'\r\n\r\n')
+    length = 0
+    for line in head.split(b'\r\n')[1:]:
+        name, _, value = line.partition(b':')
+        if name.lower() == b'content-length':
+            length = int(value)
+    while len(body) < length:
+        body += sock.recv(4096)
+    return head + b'\r\n\r\n' + body
+
+
+def read_all(sock):
+    data = b''
+    while True:
+        chunk = sock.recv(4096)
+        if not chunk:
+            return data
+        data += chunk
+
+
+def connect(server):
+    sock = socket.create_connection(server.server_address, timeout=5)
+    return sock
+
+
+def test_overloaded_clients_receive_503_before_close():
+    release = threading.Event()
+
+    def slow(environ, start_response):
+        release.wait(5)
+        return hello(environ, start_response)
+
+    with serve(slow, max_inflight=1) as server:
+        busy = connect(server)
+        busy.sendall(b'GET / HTTP/1.1\r\nHost: a\r\n\r\n')
+        wait_for(lambda: server._inflight == 1)
+
+        clients = []
+        for _ in range(20):
+            sock = connect(server)
+            # 服务器不会读取的请求字节，直接 close 会触发 RST
+            sock.sendall(b'POST / HTTP/1.1\r\nHost: a\r\n'
+                         b'Content-Length: 10\r\n\r\n0123456789')
+            clients.append(sock)
+        for sock in clients:
+            response = read_all(sock)
+            assert response.startswith(b'HTTP/1.1 503 Service Unavailable')
+            assert b'Retry-After: 1' in response
+            sock.close()
+
+        release.set()
+        assert read_response(busy).endswith(b'hello')
+        busy.close()
+
+
+def test_idle_keep_alive_connections_do_not_count_as_inflight():
+    with serve(hello, max_inflight=1) as server:
+        idle = connect(server)
+        idle.sendall(b'GET / HTTP/1.1\r\nHost: a\r\n\r\n')
+        assert read_response(idle).endswith(b'hello')
+        wait_for(lambda: server._inflight == 0)
+
+        other = connect(server)
+        other.sendall(b'GET / HTTP/1.1\r\nHost: a\r\nConnection: close\r\n\r\n')
+        assert read_all(other).startswith(b'HTTP/1.1 200 OK')
+        other.close()
+        wait_for(lambda: server._inflight == 0)
+
+        # 空闲连接收到新的请求后重新计数
+        idle.sendall(b'GET / HTTP/1.1\r\nHost: a\r\n\r\n')
+        assert read_response(idle).endswith(b'hello')
+        idle.close()
+        wait_for(lambda: server._inflight == 0)
+
+
+def test_idle_connections_are_rejected_when_overloaded():
+    release = threading.Event()
+
+    def slow(environ, start_response):
+        if environ['PATH_INFO'] == '/slow':
+            release.wait(5)
+        return hello(environ, start_response)
+
+    with serve(slow, max_inflight=1) as server:
+        idle = connect(server)
+        idle.sendall(b'GET / HTTP/1.1\r\nHost: a\r\n\r\n')
+        assert read_response(idle).endswith(b'hello')
+        wait_for(lambda: server._inflight == 0)
+
+        busy = connect(server)
+        busy.sendall(b'GET /slow HTTP/1.1\r\nHost: a\r\n\r\n')
+        wait_for(lambda: server._inflight == 1)
+
+        # 已经建立的 keep-alive 连接发来新请求，同样检查水位线
+        idle.sendall(b'GET / HTTP/1.1\r\nHost: a\r\n\r\n')
+        response = read_all(idle)
+        assert response.startswith(b'HTTP/1.1 503 Service Unavailable')
+        assert b'Connection: close' in response
+        idle.close()
+        assert server._inflight == 1
+
+        release.set()
+        assert read_response(busy).endswith(b'hello')
+        busy.close()
+        wait_for(lambda: server._inflight == 0)
+
+
+class ShortDeadlines(RequestsHandler):
+    __slots__ = ()
+    idle_timeout = header_timeout = 0.2
+    body_timeout = write_timeout = 0.2
+
+
+class LongIdle(RequestsHandler):
+    __slots__ = ()
+    idle_timeout = 0.8
+    header_timeout = body_timeout = write_timeout = 0.2
+
+
+def test_socket_timeout_outlasts_the_phase_deadlines():
+    assert RequestsHandler().socket_timeout() > max(
+        RequestsHandler.idle_timeout, RequestsHandler.write_timeout)
+
+    with serve(hello, HandlerClass=LongIdle) as server:
+        sock = connect(server)
+        sock.sendall(b'GET / HTTP/1.1\r\nHost: a\r\n\r\n')
+        assert read_response(sock).endswith(b'hello')
+        # 空闲时间由 idle_timeout 决定，比其他阶段的上限长也不会提前关闭
+        time.sleep(0.5)
+        sock.sendall(b'GET / HTTP/1.1\r\nHost: a\r\n\r\n')
+        assert read_response(sock).endswith(b'hello')
+        start = time.monotonic()
+        assert read_all(sock) == b''
+        assert 0.6 < time.monotonic() - start < 1.5
+        sock.close()
+
+
+def test_deadlines_do_not_cap_app_time_or_streamed_responses():
+    def slow(environ, start_response):
+        body = environ['wsgi.input'].read()
+        time.sleep(0.5)
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        for block in (body, b'-a', b'-b', b'-c'):
+            time.sleep(0.15)
+            yield block
+
+    with serve(slow, HandlerClass=ShortDeadlines) as server:
+        sock = connect(server)
+        sock.sendall(b'POST / HTTP/1.1\r\nHost: a\r\nConnection: close\r\n'
+                     b'Content-Length: 4\r\n\r\nbody')
+        response = read_all(sock)
+        assert response.startswith(b'HTTP/1.1 200 OK')
+        assert response.endswith(b'4\r\nbody\r\n2\r\n-a\r\n2\r\n-b\r\n'
+                                 b'2\r\n-c\r\n0\r\n\r\n')
+
+
+@pytest.mark.parametrize('sent', [
+    b'',  # idle
+    b'GET / HTTP/1.1\r\nHost: a\r\n',  # header
+    b'POST / HTTP/1.1\r\nHost: a\r\nContent-Length: 10\r\n\r\n01',  # body
+])
+def test_stalled_clients_are_disconnected(sent):
+    errors = []
+
+    def app(environ, start_response):
+        try:
+            environ['wsgi.input'].read()
+        except OSError as e:
+            errors.append(e)
+            raise
+        return hello(environ, start_response)
+
+    with serve(app, HandlerClass=ShortDeadlines) as server:
+        sock = connect(server)
+        sock.sendall(sent)
+        start = time.monotonic()
+        try:
+            assert read_all(sock) == b''
+        except ConnectionResetError:
+            pass
+        assert time.monotonic() - start < 1.5
+        sock.close()
+    assert bool(errors) == sent.endswith(b'01')
+
+
+def test_unix_socket_listener(tmp_path):
+    path = str(tmp_path / 'server.sock')
+    with serve(hello, unix_socket=path) as server:
+        assert server.is_tcp is False
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        sock.sendall(b'GET / HTTP/1.1\r\nHost: a\r\nConnection: close\r\n\r\n')
+        assert read_all(sock).endswith(b'hello')
+        sock.close()
+    # server_close() 删除套接字文件
+    assert not (tmp_path / 'server.sock').exists()
+
+
+def test_inherited_fd_listener():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    address = listener.getsockname()
+    with serve(hello, fd=listener.detach(), nodelay=True) as server:
+        assert server.server_address == address
+        sock = socket.create_connection(address, timeout=5)
+        sock.sendall(b'GET / HTTP/1.1\r\nHost: a\r\nConnection: close\r\n\r\n')
+        assert read_all(sock).endswith(b'hello')
+        sock.close()
+
+
+def has_ipv6_loopback():
+    try:
+        with socket.socket(socket.AF_INET6, socket.SOCK_STREAM) as sock:
+            sock.bind(('::1', 0))
+    except OSError:
+        return False
+    return True
+
+
+@pytest.mark.skipif(not has_ipv6_loopback(), reason='::1 unavailable')
+def test_ipv6_listener():
+    with serve(hello, host='::1') as server:
+        assert server.socket.family == socket.AF_INET6
+        sock = socket.create_connection(server.server_address, timeout=5)
+        sock.sendall(b'GET / HTTP/1.1\r\nHost: a\r\nConnection: close\r\n\r\n')
+        assert read_all(sock).endswith(b'hello')
+        sock.close()